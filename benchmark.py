@@ -0,0 +1,360 @@
+#!/usr/bin/python3
+import os
+import tempfile
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from sys import argv
+
+import compiler
+
+
+function_template = """
+int function_{n}(int index, int format) {{
+    int total = 0;
+    if (index < 0) {{
+        return;
+    }}
+    for (int step = 0; step < index; step = step + 1) {{
+        if (step % 3 == 0 && format != {n}) {{
+            total = total + step * {n} - format / 2;
+        }} else {{
+            total = total - (step + {n}) * 2;
+        }}
+    }}
+    while (total > 1000) {{
+        total = total / 2;
+    }}
+    return total > 0 ? total : -total;
+}}
+"""
+
+
+def generate_source(functions, called=None):
+    # main calls the first `called` functions, all of them by default, the
+    # others are dead code
+    source = ''
+    for n in range(functions):
+        source += function_template.format(n=n)
+    source += '\nint main() {\n    int total = 0;\n'
+    for n in range(functions if called is None else called):
+        source += f'    total = total + function_{n}(10, 3);\n'
+    source += '    return total;\n}\n'
+    return source
+
+
+def benchmark_lexer(functions=20000):
+    script = generate_source(functions)
+    start = time.perf_counter()
+    tokens = compiler.create_tokens(script)
+    elapsed = time.perf_counter() - start
+    print(f"lexer: {len(script)} bytes, {len(tokens)} tokens in {elapsed:.3f}s "
+          f"({len(tokens) / elapsed:,.0f} tokens/s)")
+    token_size = tokens.kinds.itemsize + tokens.starts.itemsize + tokens.ends.itemsize
+    print(f"lexer: {token_size} bytes per token in the token buffer")
+
+    with tempfile.TemporaryFile() as source_file:
+        source_file.write(script.encode())
+        source_file.flush()
+        mapped_script = compiler.map_source(source_file)
+        start = time.perf_counter()
+        tokens = compiler.create_tokens(mapped_script)
+        elapsed = time.perf_counter() - start
+        mapped_script.close()
+    print(f"lexer: memory mapped file, {len(tokens)} tokens in {elapsed:.3f}s "
+          f"({len(tokens) / elapsed:,.0f} tokens/s)")
+
+
+def benchmark_parser(functions=20000):
+    tokens = compiler.create_tokens(generate_source(functions))
+    start = time.perf_counter()
+    compiler.parse_tokens(tokens)
+    elapsed = time.perf_counter() - start
+    print(f"parser: {len(tokens)} tokens in {elapsed:.3f}s ({len(tokens) / elapsed:,.0f} tokens/s)")
+
+
+def benchmark_generator(functions=20000):
+    tree = compiler.parse_tokens(compiler.create_tokens(generate_source(functions)))
+    start = time.perf_counter()
+    assembly = compiler.generate(tree)
+    elapsed = time.perf_counter() - start
+    print(f"generator: {len(assembly)} bytes of assembly in {elapsed:.3f}s "
+          f"({len(assembly) / elapsed / 1e6:.2f} MB/s)")
+
+
+def benchmark_stream(functions=2000):
+    script = generate_source(functions)
+
+    tracemalloc.start()
+    compiler.generate(compiler.parse_tokens(compiler.create_tokens(script)))
+    whole_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    with open(os.devnull, 'w') as output_file:
+        compiler.compile_stream(script, output_file)
+    stream_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f"stream: peak memory {whole_peak / 1e6:.1f} MB for the whole translation unit, "
+          f"{stream_peak / 1e6:.1f} MB streaming ({len(script) / 1e6:.1f} MB of source)")
+
+
+def benchmark_batch(files=32, functions=200):
+    with tempfile.TemporaryDirectory() as directory:
+        file_names = []
+        for n in range(files):
+            file_name = os.path.join(directory, f'unit_{n}.c')
+            with open(file_name, 'w') as source_file:
+                source_file.write(generate_source(functions))
+            file_names.append(file_name)
+
+        for jobs in sorted({1, os.cpu_count()}):
+            start = time.perf_counter()
+            with open(os.devnull, 'w') as summary, redirect_stdout(summary):
+                compiler.compile_batch(file_names, jobs, dict(compiler.default_options))
+            elapsed = time.perf_counter() - start
+            print(f"batch: {files} files with {jobs} jobs in {elapsed:.3f}s ({files / elapsed:.1f} files/s)")
+
+
+def benchmark_cache(files=32, functions=200):
+    with tempfile.TemporaryDirectory() as directory:
+        cache_directory = os.path.join(directory, 'cache')
+        file_names = []
+        for n in range(files):
+            file_name = os.path.join(directory, f'unit_{n}.c')
+            with open(file_name, 'w') as source_file:
+                source_file.write(f'int unit_{n};\n' + generate_source(functions))
+            file_names.append(file_name)
+
+        for run in ('cold', 'warm'):
+            start = time.perf_counter()
+            for file_name in file_names:
+                compiler.compile_file(file_name, dict(compiler.default_options), cache_directory, 1 << 30)
+            elapsed = time.perf_counter() - start
+            print(f"cache: {files} files {run} in {elapsed:.3f}s ({files / elapsed:.1f} files/s)")
+
+
+def benchmark_incremental(functions=5000):
+    script = generate_source(functions)
+    edited_script = script.replace('total / 2;', 'total / 3;', 1)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = compiler.CompileCache(directory, 1 << 30)
+        for run, source in (('cold', script), ('one function edited', edited_script)):
+            session = compiler.CompilerSession(cache)
+            with open(os.devnull, 'w') as output_file:
+                session.compile(source, output_file)
+            statistics = session.statistics
+            print(f"incremental: {functions} functions {run} in {statistics['seconds']:.3f}s "
+                  f"({statistics['function_hits']} reused, {statistics['function_misses']} generated)")
+
+
+def benchmark_codegen_jobs(functions=5000):
+    script = generate_source(functions)
+    for jobs in sorted({1, os.cpu_count()}):
+        session = compiler.CompilerSession(codegen_jobs=jobs)
+        with open(os.devnull, 'w') as output_file:
+            session.compile(script, output_file)
+        print(f"codegen jobs: {functions} functions with {jobs} jobs in {session.statistics['seconds']:.3f}s")
+
+
+def benchmark_peephole(functions=2000):
+    tree = compiler.parse_tokens(compiler.create_tokens(generate_source(functions)))
+    session = compiler.CompilerSession()
+    start = time.perf_counter()
+    assembly = compiler.generate(tree, session)
+    elapsed = time.perf_counter() - start
+    removed = session.statistics['peephole_removed']
+    kept = sum(1 for line in assembly.splitlines() if line.startswith('    '))
+    print(f"peephole: {functions} functions generated in {elapsed:.3f}s, {sum(removed.values())} instructions "
+          f"and labels removed, {kept} instructions left")
+    for name, count in sorted(removed.items()):
+        print(f"peephole: {name} removed {count}")
+
+
+def benchmark_dead_code(functions=2000):
+    for called in (functions, functions // 2):
+        tree = compiler.parse_tokens(compiler.create_tokens(generate_source(functions, called)))
+        session = compiler.CompilerSession()
+        start = time.perf_counter()
+        assembly = compiler.generate(tree, session)
+        elapsed = time.perf_counter() - start
+        statistics = session.statistics
+        removed = statistics['peephole_removed']
+        print(f"dead code: {called} of {functions} functions called, {statistics['functions_removed']} removed, "
+              f"{len(assembly)} bytes of assembly in {elapsed:.3f}s, {statistics['stores_removed']} stores, "
+              f"{removed.get('unreachable_code', 0)} unreachable instructions and "
+              f"{removed.get('unreferenced_label', 0)} labels removed")
+
+
+def benchmark_ir(functions=2000):
+    tree_tokens = compiler.create_tokens(generate_source(functions))
+    for backend in ('ast', 'ir'):
+        tree = compiler.parse_tokens(tree_tokens)
+        session = compiler.CompilerSession(backend=backend)
+        start = time.perf_counter()
+        assembly = compiler.generate(tree, session)
+        elapsed = time.perf_counter() - start
+        instructions = sum(1 for line in assembly.splitlines() if line.startswith('    '))
+        print(f"ir: {backend} backend, {functions} functions in {elapsed:.3f}s, {instructions} instructions")
+
+
+def benchmark_strength_reduction(functions=2000):
+    tree_tokens = compiler.create_tokens(generate_source(functions))
+    for optimize in (0, 1):
+        tree = compiler.parse_tokens(tree_tokens)
+        assembly = compiler.generate(tree, compiler.CompilerSession(optimize=optimize))
+        counts = {op: 0 for op in ('idiv', 'imul', 'lea', 'shl', 'sar')}
+        for line in assembly.splitlines():
+            op = line.split(maxsplit=1)[0] if line.startswith('    ') else None
+            if op in counts:
+                counts[op] += 1
+        print(f"strength reduction: -O{optimize}, {functions} functions, " +
+              ", ".join(f"{count} {op}" for op, count in counts.items()))
+
+
+def benchmark_instruction_selection(functions=2000):
+    tree_tokens = compiler.create_tokens(generate_source(functions))
+    for optimize in (0, 1):
+        tree = compiler.parse_tokens(tree_tokens)
+        assembly = compiler.generate(tree, compiler.CompilerSession(optimize=optimize))
+        instructions = [line.split() for line in assembly.splitlines()
+                        if line.startswith('    ') and not line.startswith('    .')]
+        immediates = sum(1 for instruction in instructions if len(instruction) > 1 and instruction[1][0] == '$')
+        memory = sum(1 for instruction in instructions
+                     if instruction[0] not in ('movq', 'mov', 'push', 'pop', 'lea') and '(' in ''.join(instruction[1:]))
+        idioms = {op: sum(1 for instruction in instructions if instruction[0] == op) for op in ('lea', 'test', 'xor')}
+        print(f"instruction selection: -O{optimize}, {functions} functions, {len(instructions)} instructions, "
+              f"{immediates} with an immediate, {memory} computing on a memory operand, " +
+              ", ".join(f"{count} {op}" for op, count in idioms.items()))
+
+
+calls_source = """
+int fib(int n) {
+    if (n < 2) return n;
+    return fib(n - 1) + fib(n - 2);
+}
+
+int combine(int a, int b, int c, int d, int e, int f, int g, int h) {
+    return a + b * 2 + c * 3 + d * 4 + e * 5 + f * 6 + g * 7 + h * 8;
+}
+
+int walk(int depth, int seed) {
+    if (depth == 0) return seed % 7;
+    return combine(walk(depth - 1, seed + 1), walk(depth - 1, seed + 2), depth, seed, 1, 2, 3, fib(depth)) % 1000;
+}
+
+int main() {
+    return walk(10, 1) + fib(20);
+}
+"""
+
+
+def benchmark_calls(copies=1000):
+    # instructions per call site in call heavy code, the sequence around
+    # each call is what the calling convention costs
+    tree_tokens = compiler.create_tokens(calls_source)
+    for optimize in (0, 1):
+        session = compiler.CompilerSession(optimize=optimize)
+        start = time.perf_counter()
+        for _ in range(copies):
+            assembly = compiler.generate(compiler.parse_tokens(tree_tokens), session)
+        elapsed = time.perf_counter() - start
+        instructions = [line.split()[0] for line in assembly.splitlines()
+                        if line.startswith('    ') and not line.startswith('    .')]
+        calls = instructions.count('callq')
+        print(f"calls: -O{optimize}, {calls} call sites, {len(instructions)} instructions "
+              f"({len(instructions) / calls:.1f} per call site), "
+              f"generated {copies} times in {elapsed:.3f}s")
+
+
+frame_source = """
+int clamp(int x, int low, int high) {
+    if (x < low) return low;
+    if (x > high) return high;
+    return x;
+}
+
+int scopes(int n) {
+    int total = 0;
+    for (int i = 0; i < n; i = i + 1) {
+        if (i % 2) { int a = i * 3; int b = a + n; total = total + a - b; }
+        else { int c = i + 5; total = total + c; }
+    }
+    while (n > 0) { int d = clamp(n, 2, 9); total = total + d; n = n - 1; }
+    return total;
+}
+
+int main() {
+    return scopes(40) + clamp(12, 0, 10);
+}
+"""
+
+
+def benchmark_frame(copies=1000):
+    # stack adjusting and frame pointer instructions, each function should
+    # move %rsp once on the way in and once on the way out
+    tree_tokens = compiler.create_tokens(frame_source)
+    for optimize, omit_frame_pointer in ((0, False), (1, False), (1, True)):
+        session = compiler.CompilerSession(optimize=optimize, omit_frame_pointer=omit_frame_pointer)
+        start = time.perf_counter()
+        for _ in range(copies):
+            assembly = compiler.generate(compiler.parse_tokens(tree_tokens), session)
+        elapsed = time.perf_counter() - start
+        instructions = [line.split() for line in assembly.splitlines()
+                        if line.startswith('    ') and not line.startswith('    .')]
+        frame = sum(1 for insn in instructions if insn[-1] in ('%rsp', '%rbp'))
+        flag = ' --omit-frame-pointer' if omit_frame_pointer else ''
+        print(f"frame: -O{optimize}{flag}, {frame} of {len(instructions)} instructions set up or move the frame, "
+              f"generated {copies} times in {elapsed:.3f}s")
+
+
+def nested_blocks_source(depth):
+    return ('int main() {\n    int x = 1;\n' + 'if (x) {\n' * depth + 'x = x + 1;\n' + '}\n' * depth +
+            '    return x;\n}\n')
+
+
+def nested_expression_source(depth):
+    return 'int main() {\n    int x = 1;\n    return ' + '-(x + ' * depth + '1' + ')' * depth + ';\n}\n'
+
+
+def benchmark_nesting(depths=(1000, 10000, 100000)):
+    for shape, make_source in (('blocks', nested_blocks_source), ('expression', nested_expression_source)):
+        for depth in depths:
+            tokens = compiler.create_tokens(make_source(depth))
+            start = time.perf_counter()
+            compiler.parse_tokens(tokens)
+            elapsed = time.perf_counter() - start
+            print(f"nesting: parse {shape} depth {depth} in {elapsed:.3f}s "
+                  f"({elapsed / depth * 1e6:.2f} us per level)")
+        for depth in depths:
+            tree = compiler.parse_tokens(compiler.create_tokens(make_source(depth)))
+            start = time.perf_counter()
+            compiler.generate(tree)
+            elapsed = time.perf_counter() - start
+            print(f"nesting: generate {shape} depth {depth} in {elapsed:.3f}s "
+                  f"({elapsed / depth * 1e6:.2f} us per level)")
+
+
+benchmarks = dict(
+    lexer=benchmark_lexer,
+    parser=benchmark_parser,
+    generator=benchmark_generator,
+    stream=benchmark_stream,
+    batch=benchmark_batch,
+    cache=benchmark_cache,
+    incremental=benchmark_incremental,
+    codegen_jobs=benchmark_codegen_jobs,
+    peephole=benchmark_peephole,
+    dead_code=benchmark_dead_code,
+    ir=benchmark_ir,
+    strength_reduction=benchmark_strength_reduction,
+    instruction_selection=benchmark_instruction_selection,
+    calls=benchmark_calls,
+    frame=benchmark_frame,
+    nesting=benchmark_nesting,
+)
+
+
+if __name__ == "__main__":
+    names = argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -3,10 +3,21 @@
 # © 2020
 # updated july 8 2021
 # updated june 4 2022
-import copy
+import argparse
+import glob
+import hashlib
+import json
+import mmap
+import os
+import pickle
 import re
-from sys import argv
-from more_itertools import peekable
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from itertools import repeat
 
 
 tokenType = dict(
@@ -46,27 +57,145 @@ tokenType = dict(
     mod="%",
     comma=",",
 )
-clause_label_number = 0
-clause_end_number = 0
-clause_false_branch_label = 0
-clause_post_conditional_number = 0
-clause_while_start_number = 0
-clause_while_end_number = 0
-clause_for_start_number = 0
-clause_for_end_number = 0
-clause_for_post_expression_number = 0
-
-
-class Token:
-    def __init__(self, value, token_type):
-        self.value = value
-        self.token_type = token_type
 
 
-re_pattern = ''
-for item in tokenType.items():
-    re_pattern += f'{item[1]}|'
-re_pattern = re_pattern[:-1]
+# integer kind codes, one per tokenType entry, used everywhere instead of the
+# raw patterns. A plain class keeps attribute lookups as cheap as a dict hit.
+class TokenKind:
+    open_brace = 0
+    close_brace = 1
+    open_parenthesis = 2
+    close_parenthesis = 3
+    semi_colon = 4
+    int_keyword = 5
+    return_ = 6
+    integer_literal = 7
+    negation = 8
+    bitwise_complement = 9
+    addition = 10
+    multiplication = 11
+    division = 12
+    logical_and = 13
+    logical_or = 14
+    equal = 15
+    not_equal = 16
+    less_than_equal = 17
+    less_than = 18
+    greater_than_or_equal = 19
+    greater_then = 20
+    logical_negation = 21
+    assignment = 22
+    if_ = 23
+    else_ = 24
+    colon = 25
+    question_mark = 26
+    for_keyword = 27
+    while_keyword = 28
+    do_keyword = 29
+    break_keyword = 30
+    continue_keyword = 31
+    identifier = 32
+    mod = 33
+    comma = 34
+    end_of_input = 35
+
+
+token_kind_names = {getattr(TokenKind, name): name for name in vars(TokenKind) if not name.startswith('_')}
+
+
+class TokenBuffer:
+    # struct of arrays: a kind code plus start/end offsets into the source per
+    # token, token text is only sliced out when asked for. A buffer can also be
+    # filled lazily by a scanner and have its consumed prefix released.
+    def __init__(self, source):
+        self.source = source
+        self.kinds = array('H')
+        self.starts = array('Q')
+        self.ends = array('Q')
+        self.scanner = None
+        self.released = 0
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def value(self, index):
+        return self.source[self.starts[index]:self.ends[index]]
+
+    def span_bytes(self, first, end):
+        # source text of the tokens first up to (not including) end
+        return self.source[self.starts[first]:self.ends[end - 1]].encode()
+
+    def position(self, index):
+        return self.line_column(self.starts[index])
+
+    def line_column(self, offset):
+        line = self.source.count('\n', 0, offset) + 1
+        column = offset - self.source.rfind('\n', 0, offset)
+        return line, column
+
+    def fill(self):
+        # scans the next batch of tokens, returns False once the source is
+        # exhausted
+        if self.scanner is None:
+            return False
+        if next(self.scanner, None) is None:
+            self.scanner = None
+        return True
+
+    def release(self, count):
+        self.released += count
+        del self.kinds[:count]
+        del self.starts[:count]
+        del self.ends[:count]
+
+
+class MappedTokenBuffer(TokenBuffer):
+    # token buffer over a bytes-like source such as a memory mapped file, the
+    # offsets are byte offsets and values are decoded when sliced out
+    def value(self, index):
+        return self.source[self.starts[index]:self.ends[index]].decode()
+
+    def span_bytes(self, first, end):
+        return self.source[self.starts[first]:self.ends[end - 1]]
+
+    def line_column(self, offset):
+        line = self.source[:offset].count(b'\n') + 1
+        column = offset - self.source.rfind(b'\n', 0, offset)
+        return line, column
+
+
+def new_token_buffer(source):
+    if isinstance(source, str):
+        return TokenBuffer(source)
+    return MappedTokenBuffer(source)
+
+
+def map_source(source_file):
+    # maps the file read only so pages are only loaded as the lexer reaches
+    # them, an empty file cannot be mapped and is returned as empty bytes.
+    # Either way the result is a context manager giving the source.
+    if os.fstat(source_file.fileno()).st_size == 0:
+        return nullcontext(b'')
+    return mmap.mmap(source_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# keywords are matched as identifiers first (maximal munch) and then resolved
+# with a dict lookup, so `index` or `format` stay single identifiers.
+# Whitespace, identifiers and literals come first in the alternation because
+# they are by far the most frequent matches.
+keyword_kinds = {pattern: getattr(TokenKind, name) for name, pattern in tokenType.items() if pattern.isalpha()}
+group_kinds = {name: getattr(TokenKind, name) for name in tokenType}
+frequent_token_names = ['identifier', 'integer_literal']
+
+token_pattern = re.compile('|'.join(
+    ['(?P<whitespace>\\s+)'] +
+    [f'(?P<{name}>{tokenType[name]})' for name in frequent_token_names] +
+    [f'(?P<{name}>{pattern})' for name, pattern in tokenType.items()
+     if not pattern.isalpha() and name not in frequent_token_names] +
+    ['(?P<mismatch>.)']))
+
+byte_token_pattern = re.compile(token_pattern.pattern.encode())
+byte_keyword_kinds = {keyword.encode(): kind for keyword, kind in keyword_kinds.items()}
 
 # text = """
 # int main() {
@@ -75,23 +204,83 @@ re_pattern = re_pattern[:-1]
 # """
 
 
-def create_tokens(script):
-    string_tokens = re.findall(re_pattern, script)
+def scan_tokens(tokens, batch_size=4096, chunk_size=1 << 20):
+    # appends the tokens of tokens.source to the buffer, pausing after every
+    # batch_size tokens so the buffer can be filled on demand. The source is
+    # matched one chunk at a time; a match touching the end of a chunk may
+    # continue in the next one, so it is scanned again from the next chunk.
+    source = tokens.source
+    if isinstance(source, str):
+        pattern = token_pattern
+        keywords = keyword_kinds
+    else:
+        pattern = byte_token_pattern
+        keywords = byte_keyword_kinds
+    add_kind = tokens.kinds.append
+    add_start = tokens.starts.append
+    add_end = tokens.ends.append
+    identifier_kind = TokenKind.identifier
+    size = len(source)
+    chunk_start = 0
+    read_size = chunk_size
+    count = 0
+
+    while chunk_start < size:
+        chunk = source[chunk_start:chunk_start + read_size]
+        last_chunk = chunk_start + read_size >= size
+        chunk_length = len(chunk)
+        consumed = 0
+
+        for match in pattern.finditer(chunk):
+            start, end = match.span()
+            if end == chunk_length and not last_chunk:
+                break
+            consumed = end
+            name = match.lastgroup
+            if name == 'whitespace':
+                continue
+            if name == 'identifier':
+                add_kind(keywords.get(chunk[start:end], identifier_kind))
+            elif name == 'mismatch':
+                character = match.group()
+                if isinstance(character, bytes):
+                    character = character.decode(errors='replace')
+                line, column = tokens.line_column(chunk_start + start)
+                raise SyntaxError(f"unexpected character {character!r} at line {line}, column {column}")
+            else:
+                add_kind(group_kinds[name])
+            add_start(chunk_start + start)
+            add_end(chunk_start + end)
 
-    def map_token_to_type(token):
-        for item in tokenType.items():
-            if re.match(item[1], token):
-                return Token(token, item[1])
+            count += 1
+            if count == batch_size:
+                count = 0
+                yield True
+
+        if consumed == 0 and not last_chunk:
+            # a single token longer than the chunk
+            read_size *= 2
+            continue
+        chunk_start += consumed
+        read_size = chunk_size
+
+
+def create_tokens(script):
+    tokens = new_token_buffer(script)
+    for _ in scan_tokens(tokens):
+        pass
+    return tokens
 
-    tokens = []
-    for token in string_tokens:
-        tokens.append(map_token_to_type(token))
 
+def create_token_stream(script):
+    tokens = new_token_buffer(script)
+    tokens.scanner = scan_tokens(tokens)
     return tokens
 
 
-# for t in create_tokens(text):
-#     print(t.value, t.token_type)
+# tokens = create_tokens(text)
+# for index in range(len(tokens)):
+#     print(tokens.value(index), token_kind_names[tokens.kinds[index]])
 
 class Node:
     def __init__(self):
@@ -218,344 +407,307 @@ class FunctionCallNode:
         self.args = []
 
 
+class TokenCursor:
+    # index based view over a TokenBuffer: peeking is an array lookup and
+    # backtracking is just moving the index back with mark()/reset()
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.kinds = tokens.kinds
+        self.length = len(tokens.kinds)
+        self.index = 0
+
+    def peek(self, offset=0):
+        index = self.index + offset
+        if index < self.length:
+            return self.kinds[index]
+        while self.tokens.fill():
+            self.length = len(self.kinds)
+            if index < self.length:
+                return self.kinds[index]
+        return TokenKind.end_of_input
+
+    def advance(self):
+        index = self.index
+        self.index = index + 1
+        return index
+
+    def expect(self, kind, message):
+        index = self.index
+        if self.peek() != kind:
+            raise self.error(message)
+        self.index = index + 1
+        return index
+
+    def value(self, index):
+        return self.tokens.value(index)
+
+    def mark(self):
+        return self.index
+
+    def reset(self, mark):
+        self.index = mark
+
+    def release(self):
+        # drops every consumed token, only safe where no mark() is pending
+        self.tokens.release(self.index)
+        self.length -= self.index
+        self.index = 0
+
+    def error(self, message):
+        if self.peek() == TokenKind.end_of_input:
+            return SyntaxError(f"{message} at end of input")
+        line, column = self.tokens.position(self.index)
+        return SyntaxError(f"{message} at line {line}, column {column}")
+
+
+def run_iteratively(task):
+    # Drives generator based recursive functions with an explicit stack instead
+    # of the Python call stack: a task yields a sub-task to "call" it and gets
+    # the sub-task's return value back, so nesting depth is only bounded by
+    # memory.
+    stack = []
+    value = None
+    while True:
+        try:
+            sub_task = task.send(value)
+        except StopIteration as finished:
+            if not stack:
+                return finished.value
+            task = stack.pop()
+            value = finished.value
+        else:
+            stack.append(task)
+            task = sub_task
+            value = None
+
+
 def parse_program(tokens):
     tree = ProgramNode()
-    top_level_item = parse_top_level_item(tokens)
+    top_level_item = yield parse_top_level_item(tokens)
     tree.top_level_items.append(top_level_item)
 
-    try:
-        next_token = tokens.peek()
-    except:
-        return tree
-
-    while next_token.token_type == tokenType['int_keyword']:
-        top_level_item = parse_top_level_item(tokens)
+    while tokens.peek() == TokenKind.int_keyword:
+        top_level_item = yield parse_top_level_item(tokens)
         tree.top_level_items.append(top_level_item)
-        try:
-            next_token = tokens.peek()
-        except:
-            return tree
 
     return tree
 
 
 def parse_top_level_item(tokens):
-    intKeywordToken = next(tokens)
-    if intKeywordToken.token_type != tokenType['int_keyword']:
-        raise 'int keyword expected'
+    if tokens.peek() != TokenKind.int_keyword:
+        raise tokens.error('int keyword expected')
 
-    idToken = next(tokens)
-    if idToken.token_type != tokenType['identifier']:
-        raise 'id expected'
+    if tokens.peek(1) != TokenKind.identifier:
+        raise tokens.error('id expected')
 
-    nextToken = tokens.peek()
-
-    if nextToken.token_type == tokenType['open_parenthesis']:
-        tokens.prepend(idToken)
-        tokens.prepend(intKeywordToken)
-        node = parse_function(tokens)
+    if tokens.peek(2) == TokenKind.open_parenthesis:
+        node = yield parse_function(tokens)
     else:
-        tokens.prepend(idToken)
-        tokens.prepend(intKeywordToken)
-        node = parse_declaration(tokens)
+        node = yield parse_declaration(tokens)
 
     return node
 
 
 def parse_function(tokens):
-    type_keyword = next(tokens)
+    tokens.expect(TokenKind.int_keyword, "type expected")
+    function_identifier = tokens.expect(TokenKind.identifier, "identifier expected")
 
-    if type_keyword.token_type != tokenType['int_keyword']:
-        raise "type expected"
+    node = FunctionNode(tokens.value(function_identifier))
 
-    function_identifier = next(tokens)
-    if function_identifier.token_type != tokenType['identifier']:
-        raise "identifier expected"
+    tokens.expect(TokenKind.open_parenthesis, "( expected")
 
-    node = FunctionNode(function_identifier.value)
+    if tokens.peek() != TokenKind.close_parenthesis:
+        tokens.expect(TokenKind.int_keyword, "int keyword expected")
+        token = tokens.expect(TokenKind.identifier, "identifier expected")
+        node.variables.append(tokens.value(token))
 
-    open_parenthesis = next(tokens)
-    if open_parenthesis.token_type != tokenType['open_parenthesis']:
-        raise "( expected"
+        while tokens.peek() != TokenKind.close_parenthesis:
+            tokens.expect(TokenKind.comma, ",  expected")
+            tokens.expect(TokenKind.int_keyword, "int keyword expected")
+            token = tokens.expect(TokenKind.identifier, "identifier expected")
+            node.variables.append(tokens.value(token))
 
-    next_token = tokens.peek()
+    tokens.expect(TokenKind.close_parenthesis, ") expected")
 
-    if next_token.token_type != tokenType['close_parenthesis']:
-        token = next(tokens)
-        if token.token_type != tokenType['int_keyword']:
-            raise "int keyword expected"
-        token = next(tokens)
-        node.variables.append(token.value)
-        next_token = tokens.peek()
-
-        while next_token.token_type != tokenType['close_parenthesis']:
-            token = next(tokens)
-            if token.token_type != tokenType['comma']:
-                raise ",  expected"
-            token = next(tokens)
-            if token.token_type != tokenType['int_keyword']:
-                raise "int keyword expected"
-            token = next(tokens)
-            node.variables.append(token.value)
-            next_token = tokens.peek()
-
-    close_parenthesis = next(tokens)
-    if close_parenthesis.token_type != tokenType['close_parenthesis']:
-        raise ") expected"
-
-    next_token = next(tokens)
-
-    if next_token.token_type == tokenType['semi_colon']:
+    if tokens.peek() == TokenKind.semi_colon:
+        tokens.advance()
         return NullNode()
 
-    if next_token.token_type != tokenType['open_brace']:
-        raise "{ expected"
+    tokens.expect(TokenKind.open_brace, "{ expected")
 
-    next_token = tokens.peek()
     node.statements = []
 
-    while next_token.token_type != tokenType['close_brace']:
-        node.statements.append(parse_block_item(tokens))
-        next_token = tokens.peek()
+    while tokens.peek() != TokenKind.close_brace:
+        node.statements.append((yield parse_block_item(tokens)))
 
-    close_brace_token = next(tokens)
-    if close_brace_token.token_type != tokenType['close_brace']:
-        raise "} expected"
+    tokens.expect(TokenKind.close_brace, "} expected")
 
     return node
 
 
 def parse_function_call(tokens):
-    token = next(tokens)
-    if token.token_type != tokenType['identifier']:
-        raise 'Identifier expected'
+    token = tokens.expect(TokenKind.identifier, 'Identifier expected')
     node = FunctionCallNode()
-    node.name = token.value
-
-    open_parenthesis = next(tokens)
-    if open_parenthesis.token_type != tokenType['open_parenthesis']:
-        raise "( expected"
+    node.name = tokens.value(token)
 
-    next_token = tokens.peek()
+    tokens.expect(TokenKind.open_parenthesis, "( expected")
 
-    if next_token.token_type != tokenType['close_parenthesis']:
-        param = parse_expression(tokens)
+    if tokens.peek() != TokenKind.close_parenthesis:
+        param = yield parse_expression(tokens)
         node.args.append(param)
 
-        next_token = tokens.peek()
-        while next_token.token_type != tokenType['close_parenthesis']:
-            token = next(tokens)
-            if token.token_type != tokenType['comma']:
-                raise ",  expected"
-            param = parse_expression(tokens)
+        while tokens.peek() != TokenKind.close_parenthesis:
+            tokens.expect(TokenKind.comma, ",  expected")
+            param = yield parse_expression(tokens)
             node.args.append(param)
-            next_token = tokens.peek()
 
-    close_parenthesis = next(tokens)
-    if close_parenthesis.token_type != tokenType['close_parenthesis']:
-        raise ") expected"
+    tokens.expect(TokenKind.close_parenthesis, ") expected")
 
     return node
 
 
 def parse_statement(tokens):
     next_token = tokens.peek()
-    if next_token.token_type == tokenType['return_']:
-        token = next(tokens)
-        node = ReturnNode(token.value)
+    if next_token == TokenKind.return_:
+        tokens.advance()
+        node = ReturnNode(TokenKind.return_)
 
-        node.left = parse_option_expression(tokens)
+        node.left = yield parse_option_expression(tokens)
 
-        token = next(tokens)
-        if token.token_type != tokenType['semi_colon']:
-            raise "; expected after returnKeyword"
+        tokens.expect(TokenKind.semi_colon, "; expected after returnKeyword")
         return node
 
-    elif next_token.token_type == tokenType['if_']:
+    elif next_token == TokenKind.if_:
         node = IfNode()
-        next(tokens)
-        token = next(tokens)
-        if token.token_type != tokenType['open_parenthesis']:
-            raise '( expected'
+        tokens.advance()
+        tokens.expect(TokenKind.open_parenthesis, '( expected')
 
-        node.condition = parse_expression(tokens)
+        node.condition = yield parse_expression(tokens)
 
-        token = next(tokens)
-        if token.token_type != tokenType['close_parenthesis']:
-            raise ') expected'
+        tokens.expect(TokenKind.close_parenthesis, ') expected')
 
-        true_branch = parse_statement(tokens)
+        true_branch = yield parse_statement(tokens)
 
         node.true_branch = true_branch
 
-        next_token = tokens.peek()
-        if next_token.token_type == tokenType['else_']:
-            next(tokens)
-            node.false_branch = parse_statement(tokens)
+        if tokens.peek() == TokenKind.else_:
+            tokens.advance()
+            node.false_branch = yield parse_statement(tokens)
         return node
 
-    elif next_token.token_type == tokenType['open_brace']:
-        node = parse_compound_block(tokens)
+    elif next_token == TokenKind.open_brace:
+        node = yield parse_compound_block(tokens)
         return node
 
-    elif next_token.token_type == tokenType['for_keyword']:
-        for_token = next(tokens)
-        parenthesis_token = next(tokens)
-        next_token = tokens.peek()
-        if next_token.token_type == tokenType['int_keyword']:
-            tokens.prepend(parenthesis_token)
-            tokens.prepend(for_token)
-            node = parse_for_declaration(tokens)
-            return node
-        tokens.prepend(parenthesis_token)
-        tokens.prepend(for_token)
-        next_token = tokens.peek()
-
-    if next_token.token_type == tokenType['for_keyword']:
-        node = parse_for(tokens)
+    elif next_token == TokenKind.for_keyword:
+        if tokens.peek(2) == TokenKind.int_keyword:
+            node = yield parse_for_declaration(tokens)
+        else:
+            node = yield parse_for(tokens)
 
-    elif next_token.token_type == tokenType['while_keyword']:
-        node = parse_while(tokens)
+    elif next_token == TokenKind.while_keyword:
+        node = yield parse_while(tokens)
 
-    elif next_token.token_type == tokenType['do_keyword']:
-        node = parse_do_while(tokens)
+    elif next_token == TokenKind.do_keyword:
+        node = yield parse_do_while(tokens)
 
-    elif next_token.token_type == tokenType['break_keyword']:
+    elif next_token == TokenKind.break_keyword:
         node = parse_break(tokens)
 
-    elif next_token.token_type == tokenType['continue_keyword']:
+    elif next_token == TokenKind.continue_keyword:
         node = parse_continue(tokens)
 
     else:
-        node = parse_option_expression(tokens)
+        node = yield parse_option_expression(tokens)
 
-        token = next(tokens)
-        if token.token_type != tokenType['semi_colon']:
-            raise "; expected after assignment"
+        tokens.expect(TokenKind.semi_colon, "; expected after assignment")
 
     return node
 
 
 def parse_for(tokens):
     node = ForNode()
-    token = next(tokens)
-    if token.token_type != tokenType['for_keyword']:
-        raise "for expected"
-    token = next(tokens)
-    if token.token_type != tokenType['open_parenthesis']:
-        raise "( expected"
+    tokens.expect(TokenKind.for_keyword, "for expected")
+    tokens.expect(TokenKind.open_parenthesis, "( expected")
 
-    node.initial_expression = parse_option_expression(tokens)
+    node.initial_expression = yield parse_option_expression(tokens)
 
-    token = next(tokens)
-    if token.token_type != tokenType['semi_colon']:
-        raise "; expected after assignment"
+    tokens.expect(TokenKind.semi_colon, "; expected after assignment")
 
-    node.condition = parse_option_expression(tokens)
-    token = next(tokens)
-    if token.token_type != tokenType['semi_colon']:
-        raise "; expected after expression"
+    node.condition = yield parse_option_expression(tokens)
+    tokens.expect(TokenKind.semi_colon, "; expected after expression")
 
-    node.post_expression = parse_option_expression(tokens)
+    node.post_expression = yield parse_option_expression(tokens)
 
-    token = next(tokens)
-    if token.token_type != tokenType['close_parenthesis']:
-        raise ") expected"
+    tokens.expect(TokenKind.close_parenthesis, ") expected")
 
-    node.body = parse_statement(tokens)
+    node.body = yield parse_statement(tokens)
 
     return node
 
 
 def parse_for_declaration(tokens):
     node = ForDeclarationNode()
-    token = next(tokens)
-    if token.token_type != tokenType['for_keyword']:
-        raise "for expected"
-    token = next(tokens)
-    if token.token_type != tokenType['open_parenthesis']:
-        raise "( expected"
+    tokens.expect(TokenKind.for_keyword, "for expected")
+    tokens.expect(TokenKind.open_parenthesis, "( expected")
 
-    node.initial_expression = parse_declaration(tokens)
-    node.condition = parse_option_expression(tokens)
+    node.initial_expression = yield parse_declaration(tokens)
+    node.condition = yield parse_option_expression(tokens)
 
-    token = next(tokens)
-    if token.token_type != tokenType['semi_colon']:
-        raise "; expected after expression"
+    tokens.expect(TokenKind.semi_colon, "; expected after expression")
 
-    node.post_expression = parse_option_expression(tokens)
+    node.post_expression = yield parse_option_expression(tokens)
 
-    token = next(tokens)
-    if token.token_type != tokenType['close_parenthesis']:
-        raise ") expected"
+    tokens.expect(TokenKind.close_parenthesis, ") expected")
 
-    node.body = parse_statement(tokens)
+    node.body = yield parse_statement(tokens)
 
     return node
 
 
 def parse_while(tokens):
     node = WhileNode()
-    token = next(tokens)
-    if token.token_type != tokenType['while_keyword']:
-        raise "while expected"
-    token = next(tokens)
-    if token.token_type != tokenType['open_parenthesis']:
-        raise "( expected"
+    tokens.expect(TokenKind.while_keyword, "while expected")
+    tokens.expect(TokenKind.open_parenthesis, "( expected")
 
-    node.condition = parse_expression(tokens)
+    node.condition = yield parse_expression(tokens)
 
-    token = next(tokens)
-    if token.token_type != tokenType['close_parenthesis']:
-        raise ") expected"
+    tokens.expect(TokenKind.close_parenthesis, ") expected")
 
-    node.body = parse_statement(tokens)
+    node.body = yield parse_statement(tokens)
 
     return node
 
 
 def parse_do_while(tokens):
     node = DoWhileNode()
-    token = next(tokens)
+    tokens.expect(TokenKind.do_keyword, "do expected")
 
-    if token.token_type != tokenType['do_keyword']:
-        raise "do expected"
+    node.body = yield parse_statement(tokens)
 
-    node.body = parse_statement(tokens)
+    tokens.expect(TokenKind.while_keyword, "while expected")
 
-    token = next(tokens)
-    if token.token_type != tokenType['while_keyword']:
-        raise "while expected"
-
-    node.condition = parse_expression(tokens)
+    node.condition = yield parse_expression(tokens)
 
     return node
 
 
 def parse_break(tokens):
-    token = next(tokens)
-    if token.token_type != tokenType['break_keyword']:
-        raise "break expected"
+    tokens.expect(TokenKind.break_keyword, "break expected")
 
     node = BreakNode()
 
-    token = next(tokens)
-    if token.token_type != tokenType['semi_colon']:
-        raise "; expected after break"
+    tokens.expect(TokenKind.semi_colon, "; expected after break")
 
     return node
 
 
 def parse_continue(tokens):
-    token = next(tokens)
-    if token.token_type != tokenType['continue_keyword']:
-        raise "continue expected"
+    tokens.expect(TokenKind.continue_keyword, "continue expected")
 
     node = ContinueNode()
 
-    token = next(tokens)
-    if token.token_type != tokenType['semi_colon']:
-        raise "; expected after continue"
+    tokens.expect(TokenKind.semi_colon, "; expected after continue")
 
     return node
 
@@ -563,291 +715,645 @@ def parse_continue(tokens):
 def parse_compound_block(tokens):
     node = CompoundNode()
 
-    open_brace_token = next(tokens)
-    if open_brace_token.token_type != tokenType['open_brace']:
-        raise "{ expected"
+    tokens.expect(TokenKind.open_brace, "{ expected")
 
-    next_token = tokens.peek()
     node.statements = []
 
-    while next_token.token_type != tokenType['close_brace']:
-        node.statements.append(parse_block_item(tokens))
-        next_token = tokens.peek()
+    while tokens.peek() != TokenKind.close_brace:
+        node.statements.append((yield parse_block_item(tokens)))
 
-    close_brace_token = next(tokens)
-    if close_brace_token.token_type != tokenType['close_brace']:
-        raise "} expected"
+    tokens.expect(TokenKind.close_brace, "} expected")
 
     return node
 
 
 def parse_block_item(tokens):
-    next_token = tokens.peek()
-    if next_token.token_type == tokenType['int_keyword']:
-        node = parse_declaration(tokens)
+    if tokens.peek() == TokenKind.int_keyword:
+        node = yield parse_declaration(tokens)
     else:
-        node = parse_statement(tokens)
+        node = yield parse_statement(tokens)
 
     return node
 
 
 def parse_declaration(tokens):
-    next_token = tokens.peek()
-    if next_token.token_type == tokenType['int_keyword']:
-        d_type = next(tokens)
-        v_name = next(tokens)
-        node = DeclarationNode(v_name.value)
-        next_token = tokens.peek()
-        if next_token.token_type == tokenType['assignment']:
-            token = next(tokens)
-            node.left = parse_expression(tokens)
-
-        token = next(tokens)
-        if token.token_type != tokenType['semi_colon']:
-            raise "; expected after int"
-    else:
-        raise 'wrong declaraion'
+    tokens.expect(TokenKind.int_keyword, 'wrong declaraion')
+    v_name = tokens.expect(TokenKind.identifier, 'identifier expected')
+    node = DeclarationNode(tokens.value(v_name))
+    if tokens.peek() == TokenKind.assignment:
+        tokens.advance()
+        node.left = yield parse_expression(tokens)
+
+    tokens.expect(TokenKind.semi_colon, "; expected after int")
 
     return node
 
 
 def parse_option_expression(tokens):
     next_token = tokens.peek()
-    if next_token.token_type == tokenType['semi_colon'] or next_token.token_type == tokenType['close_parenthesis']:
+    if next_token == TokenKind.semi_colon or next_token == TokenKind.close_parenthesis:
         return NullNode()
     else:
-        return parse_expression(tokens)
+        return (yield parse_expression(tokens))
 
 
 def parse_expression(tokens):
-    identifier = next(tokens)
-    next_token = tokens.peek()
-    if identifier.token_type == tokenType['identifier'] and next_token.token_type == tokenType['assignment']:
-        node = AssignNode(identifier.value)
-        next(tokens)
-        node.left = parse_expression(tokens)
+    if tokens.peek() == TokenKind.identifier and tokens.peek(1) == TokenKind.assignment:
+        node = AssignNode(tokens.value(tokens.advance()))
+        tokens.advance()
+        node.left = yield parse_expression(tokens)
         return node
     else:
-        tokens.prepend(identifier)
-        node = parse_conditional_expression(tokens)
+        node = yield parse_conditional_expression(tokens)
 
     return node
 
 
-def parse_conditional_expression(tokens):
-    node = parse_logical_or_expression(tokens)
-    next_token = tokens.peek()
+# binding powers of the binary operators, indexed by token kind (-1 for
+# tokens that do not continue an expression). The conditional operator has
+# the lowest power and is right associative, every binary operator is left
+# associative.
+binding_powers = [-1] * (TokenKind.end_of_input + 1)
+binding_powers[TokenKind.question_mark] = 0
+binding_powers[TokenKind.logical_or] = 1
+binding_powers[TokenKind.logical_and] = 2
+binding_powers[TokenKind.equal] = 3
+binding_powers[TokenKind.not_equal] = 3
+binding_powers[TokenKind.less_than] = 4
+binding_powers[TokenKind.less_than_equal] = 4
+binding_powers[TokenKind.greater_then] = 4
+binding_powers[TokenKind.greater_than_or_equal] = 4
+binding_powers[TokenKind.addition] = 5
+binding_powers[TokenKind.negation] = 5
+binding_powers[TokenKind.multiplication] = 6
+binding_powers[TokenKind.division] = 6
+binding_powers[TokenKind.mod] = 6
+
+
+def parse_conditional_expression(tokens, min_power=0, node=None):
+    if node is None:
+        node = parse_simple_factor(tokens)
+        if node is None:
+            node = yield parse_factor(tokens)
+
+    while True:
+        op = tokens.peek()
+        power = binding_powers[op]
+        if power < min_power:
+            return node
+
+        tokens.advance()
+        if op == TokenKind.question_mark:
+            conditional_node = ConditionalNode()
+            conditional_node.condition = node
+            conditional_node.true_branch = yield parse_expression(tokens)
+            tokens.expect(TokenKind.colon, ': expected')
+            conditional_node.false_branch = yield parse_conditional_expression(tokens)
+            return conditional_node
+
+        right = parse_simple_factor(tokens)
+        if right is None or binding_powers[tokens.peek()] > power:
+            right = yield parse_conditional_expression(tokens, power + 1, right)
+        node = parse_binary_operator(op, node, right)
+
+
+def parse_binary_operator(op, term, next_term):
+    node = BinaryOperatorNode(op)
+    node.left = term
+    node.right = next_term
+    return node
+
+
+def parse_unary_operator(op, term):
+    node = UnaryOperatorNode(op)
+    node.left = term
+    return node
 
-    if next_token.token_type == tokenType['question_mark']:
-        next(tokens)
-        conditional_node = ConditionalNode()
-        conditional_node.condition = node
-        node = conditional_node
-        node.true_branch = parse_expression(tokens)
-        token = next(tokens)
-        if token.token_type != tokenType['colon']:
-            raise ': expected'
-        node.false_branch = parse_conditional_expression(tokens)
 
+def parseIntegerLiteral(literal):
+    node = ConstantNode(literal)
     return node
 
 
-def parse_logical_or_expression(tokens):
-    term = parse_logical_and_expression(tokens)
+def parse_simple_factor(tokens):
+    # literals and plain variables are handled without starting a parse_factor
+    # task, they are most of the operands
     next_token = tokens.peek()
+    if next_token == TokenKind.integer_literal:
+        return parseIntegerLiteral(tokens.value(tokens.advance()))
+    elif next_token == TokenKind.identifier and tokens.peek(1) != TokenKind.open_parenthesis:
+        return parse_variable(tokens.value(tokens.advance()))
+    return None
 
-    while next_token.token_type == tokenType['logical_or']:
-        op = next(tokens).token_type
-        nextTerm = parse_logical_and_expression(tokens)
-        term = parse_binary_operator(op, term, nextTerm)
-        next_token = tokens.peek()
 
-    return term
+def parse_factor(tokens):
+    next_token = tokens.peek()
+    if next_token == TokenKind.open_parenthesis:
+        tokens.advance()
+        exp = yield parse_expression(tokens)
+        tokens.expect(TokenKind.close_parenthesis, ') expected')
+        return exp
+    elif next_token == TokenKind.identifier and tokens.peek(1) == TokenKind.open_parenthesis:
+        node = yield parse_function_call(tokens)
+        return node
+    elif is_unary_operator(next_token):
+        tokens.advance()
+        factor = parse_simple_factor(tokens)
+        if factor is None:
+            factor = yield parse_factor(tokens)
+        return parse_unary_operator(next_token, factor)
+    elif next_token == TokenKind.integer_literal:
+        return parseIntegerLiteral(tokens.value(tokens.advance()))
+    elif next_token == TokenKind.identifier:
+        return parse_variable(tokens.value(tokens.advance()))
+    else:
+        raise tokens.error('Unrecognized Error')
 
 
-def parse_logical_and_expression(tokens):
-    term = parse_equality_expression(tokens)
-    nextToken = tokens.peek()
+def parse_variable(variable):
+    node = VariableNode(variable)
+    return node
 
-    while nextToken.token_type == tokenType['logical_and']:
-        op = next(tokens).token_type
-        nextTerm = parse_equality_expression(tokens)
-        term = parse_binary_operator(op, term, nextTerm)
-        nextToken = tokens.peek()
-    return term
 
+def is_unary_operator(kind):
+    return kind == TokenKind.negation or kind == TokenKind.bitwise_complement or kind == TokenKind.logical_negation
 
-def parse_equality_expression(tokens):
-    term = parse_relational_expression(tokens)
-    next_token = tokens.peek()
 
-    while next_token.token_type == tokenType['equal'] or next_token.token_type == tokenType['not_equal']:
-        op = next(tokens).token_type
-        nextTerm = parse_relational_expression(tokens)
-        term = parse_binary_operator(op, term, nextTerm)
-        next_token = tokens.peek()
-    return term
+def is_binary_operator(kind):
+    return kind == TokenKind.addition or kind == TokenKind.multiplication or kind == TokenKind.division or kind == TokenKind.mod
 
 
-def parse_relational_expression(tokens):
-    term = parse_additive_expression(tokens)
-    next_token = tokens.peek()
+def parse_tokens(tokens):
+    tree = run_iteratively(parse_program(TokenCursor(tokens)))
+    return tree
 
-    while (next_token.token_type == tokenType['less_than'] or next_token.token_type == tokenType['less_than_equal'] or
-           next_token.token_type == tokenType['greater_then'] or next_token.token_type == tokenType['greater_than_or_equal']):
 
-        op = next(tokens).token_type
-        nextTerm = parse_additive_expression(tokens)
-        term = parse_binary_operator(op, term, nextTerm)
-        next_token = tokens.peek()
-    return term
+# AST optimisation pass, run on every top-level item before code generation
+# at optimization level 1 and above. Folding follows the generated code, which
+# computes in 64 bit registers: results wrap to 64 bits and division truncates
+# towards zero. A division that would trap at runtime is left alone.
 
+word_mask = (1 << 64) - 1
+word_sign = 1 << 63
 
-def parse_additive_expression(tokens):
-    term = parse_term(tokens)
-    next_token = tokens.peek()
+# operators whose result is already 0 or 1
+boolean_operators = {TokenKind.equal, TokenKind.not_equal, TokenKind.greater_then, TokenKind.greater_than_or_equal,
+                     TokenKind.less_than, TokenKind.less_than_equal, TokenKind.logical_and, TokenKind.logical_or}
 
-    while next_token.token_type == tokenType['addition'] or next_token.token_type == tokenType['negation'] or next_token.token_type == tokenType['mod']:
-        op = next(tokens).token_type
-        next_term = parse_term(tokens)
-        term = parse_binary_operator(op, term, next_term)
-        next_token = tokens.peek()
-    return term
 
+def wrap_word(value):
+    value &= word_mask
+    return value - (1 << 64) if value & word_sign else value
 
-def parse_binary_operator(op, term, next_term):
-    node = BinaryOperatorNode(op)
-    node.left = term
-    node.right = next_term
+
+def constant_value(node):
+    # the value of a ConstantNode, or None for anything else. A leading zero
+    # makes the literal octal, as it does for the assembler.
+    if not isinstance(node, ConstantNode):
+        return None
+    text = node.value
+    try:
+        value = int(text, 8) if len(text) > 1 and text[0] == '0' else int(text)
+    except ValueError:
+        return None
+    return wrap_word(value)
+
+
+def new_constant(value):
+    return ConstantNode(str(value))
+
+
+def is_pure(node):
+    # no calls or assignments, so evaluating it can be skipped
+    return isinstance(node, (ConstantNode, VariableNode)) or getattr(node, 'pure', False)
+
+
+def fold_unary(operator, value):
+    if operator == TokenKind.negation:
+        return wrap_word(-value)
+    if operator == TokenKind.bitwise_complement:
+        return wrap_word(~value)
+    return int(value == 0)
+
+
+def fold_binary(operator, left, right):
+    # None where the operation has to be left to runtime
+    if operator == TokenKind.addition:
+        return wrap_word(left + right)
+    if operator == TokenKind.negation:
+        return wrap_word(left - right)
+    if operator == TokenKind.multiplication:
+        return wrap_word(left * right)
+    if operator == TokenKind.division or operator == TokenKind.mod:
+        if right == 0 or (left == -word_sign and right == -1):
+            return None
+        quotient = abs(left) // abs(right)
+        if (left < 0) != (right < 0):
+            quotient = -quotient
+        return quotient if operator == TokenKind.division else left - right * quotient
+    if operator == TokenKind.equal:
+        return int(left == right)
+    if operator == TokenKind.not_equal:
+        return int(left != right)
+    if operator == TokenKind.greater_then:
+        return int(left > right)
+    if operator == TokenKind.greater_than_or_equal:
+        return int(left >= right)
+    if operator == TokenKind.less_than:
+        return int(left < right)
+    if operator == TokenKind.less_than_equal:
+        return int(left <= right)
+    if operator == TokenKind.logical_and:
+        return int(left != 0 and right != 0)
+    if operator == TokenKind.logical_or:
+        return int(left != 0 or right != 0)
+    return None
+
+
+def new_binary(operator, left, right):
+    node = BinaryOperatorNode(operator)
+    node.left = left
+    node.right = right
+    node.pure = is_pure(left) and is_pure(right)
     return node
 
 
-def parse_unary_operator(op, term):
-    node = UnaryOperatorNode(op.token_type)
-    node.left = term
-    return node
+def is_boolean(node):
+    # the value is always 0 or 1
+    if isinstance(node, BinaryOperatorNode):
+        return node.name in boolean_operators
+    return isinstance(node, UnaryOperatorNode) and node.name == TokenKind.logical_negation
 
 
-def parseIntegerLiteral(literal):
-    node = ConstantNode(literal.value)
+def truth_value(node):
+    # node normalised to 0 or 1, as && and || produce
+    if is_boolean(node):
+        return node
+    return new_binary(TokenKind.not_equal, node, new_constant(0))
+
+
+def simplify_binary(node):
+    operator = node.name
+    left = node.left
+    right = node.right
+    if not isinstance(left, ConstantNode) and not isinstance(right, ConstantNode):
+        # every rule below needs a constant operand
+        node.pure = is_pure(left) and is_pure(right)
+        return node
+    left_value = constant_value(left)
+    right_value = constant_value(right)
+
+    if left_value is not None and right_value is not None:
+        value = fold_binary(operator, left_value, right_value)
+        if value is not None:
+            return new_constant(value)
+
+    elif operator == TokenKind.logical_and or operator == TokenKind.logical_or:
+        # a constant left side decides whether the right side runs at all, a
+        # constant right side can only go if the left side has no effects
+        absorbing = 0 if operator == TokenKind.logical_and else 1
+        if left_value is not None:
+            return new_constant(absorbing) if (left_value != 0) == absorbing else truth_value(right)
+        if right_value is not None and is_pure(left):
+            return new_constant(absorbing) if (right_value != 0) == absorbing else truth_value(left)
+
+    elif operator == TokenKind.addition or operator == TokenKind.negation:
+        if right_value is not None:
+            offset = right_value if operator == TokenKind.addition else wrap_word(-right_value)
+            # (x + a) + b and (x - a) + b become x + (a + b)
+            if isinstance(left, BinaryOperatorNode) and left.name in (TokenKind.addition, TokenKind.negation):
+                inner_value = constant_value(left.right)
+                if inner_value is not None:
+                    if left.name == TokenKind.negation:
+                        inner_value = -inner_value
+                    offset = wrap_word(offset + inner_value)
+                    left = left.left
+            if offset == 0:
+                return left
+            if offset < 0 and offset != -word_sign:
+                return new_binary(TokenKind.negation, left, new_constant(-offset))
+            return new_binary(TokenKind.addition, left, new_constant(offset))
+        if left_value == 0 and operator == TokenKind.addition:
+            return right
+
+    elif operator == TokenKind.multiplication:
+        if left_value is not None:
+            left, right, left_value, right_value = right, left, right_value, left_value
+        if right_value is not None:
+            # (x * a) * b becomes x * (a * b)
+            if isinstance(left, BinaryOperatorNode) and left.name == TokenKind.multiplication:
+                inner_value = constant_value(left.right)
+                if inner_value is not None:
+                    right_value = wrap_word(right_value * inner_value)
+                    left = left.left
+            if right_value == 1:
+                return left
+            if right_value == 0 and is_pure(left):
+                return new_constant(0)
+            return new_binary(TokenKind.multiplication, left, new_constant(right_value))
+
+    elif operator == TokenKind.division:
+        if right_value == 1:
+            return left
+
+    elif operator == TokenKind.mod:
+        if right_value == 1 and is_pure(left):
+            return new_constant(0)
+
+    node.pure = is_pure(left) and is_pure(right)
     return node
 
 
-def parse_term(tokens):
-    term = parse_factor(tokens)
-    nextToken = tokens.peek()
+# operands that cannot be simplified any further, they are skipped without
+# starting an optimize_expression task
+leaf_nodes = (ConstantNode, VariableNode, NullNode)
+
 
-    while nextToken.token_type == tokenType['multiplication'] or nextToken.token_type == tokenType['division']:
-        op = next(tokens).token_type
-        nextTerm = parse_factor(tokens)
-        term = parse_binary_operator(op, term, nextTerm)
-        nextToken = tokens.peek()
+def optimize_expression(node):
+    if isinstance(node, leaf_nodes):
+        return node
 
-    return term
+    if isinstance(node, BinaryOperatorNode):
+        if not isinstance(node.left, leaf_nodes):
+            node.left = yield optimize_expression(node.left)
+        if not isinstance(node.right, leaf_nodes):
+            node.right = yield optimize_expression(node.right)
+        return simplify_binary(node)
+
+    if isinstance(node, UnaryOperatorNode):
+        if not isinstance(node.left, leaf_nodes):
+            node.left = yield optimize_expression(node.left)
+        value = constant_value(node.left)
+        if value is not None:
+            return new_constant(fold_unary(node.name, value))
+        inner = node.left
+        if isinstance(inner, UnaryOperatorNode) and inner.name == node.name and node.name != TokenKind.logical_negation:
+            # -(-x) and ~(~x)
+            return inner.left
+        node.pure = is_pure(inner)
+        return node
 
+    if isinstance(node, ConditionalNode):
+        node.condition = yield optimize_expression(node.condition)
+        value = constant_value(node.condition)
+        if value is not None:
+            return (yield optimize_expression(node.true_branch if value != 0 else node.false_branch))
+        node.true_branch = yield optimize_expression(node.true_branch)
+        node.false_branch = yield optimize_expression(node.false_branch)
+        node.pure = is_pure(node.condition) and is_pure(node.true_branch) and is_pure(node.false_branch)
+        return node
 
-def parse_factor(tokens):
-    token = next(tokens)
-    next_token = tokens.peek()
-    if token.token_type == tokenType['open_parenthesis']:
-        exp = parse_expression(tokens)
-        if next(tokens).token_type != tokenType['close_parenthesis']:
-            raise ') expected'
-        return exp
-    elif token.token_type == tokenType['identifier'] and next_token.token_type == tokenType['open_parenthesis']:
-        tokens.prepend(token)
-        node = parse_function_call(tokens)
+    if isinstance(node, AssignNode):
+        if not isinstance(node.left, leaf_nodes):
+            node.left = yield optimize_expression(node.left)
         return node
-    elif is_unary_operator(token):
-        factor = parse_factor(tokens)
-        return parse_unary_operator(token, factor)
-    elif token.token_type == tokenType['integer_literal']:
-        return parseIntegerLiteral(token)
-    elif token.token_type == tokenType['identifier']:
-        return parse_variable(token)
-    else:
-        raise 'Unrecognized Error'
 
+    if isinstance(node, FunctionCallNode):
+        for index, argument in enumerate(node.args):
+            node.args[index] = yield optimize_expression(argument)
+        return node
 
-def parse_variable(variable):
-    node = VariableNode(variable.value)
     return node
 
 
-def is_unary_operator(token):
-    return token.token_type == tokenType['negation'] or token.token_type == tokenType['bitwise_complement'] or token.token_type == tokenType['logical_negation']
+def diverts(node):
+    # control never reaches the statement after node
+    return isinstance(node, (ReturnNode, BreakNode, ContinueNode)) or getattr(node, 'diverts', False)
 
 
-def is_binary_operator(token):
-    return token.token_type == tokenType['addition'] or token.token_type == tokenType['multiplication'] or token.token_type == tokenType['division'] or token.token_type == tokenType['mod']
+def optimize_statements(statements):
+    # the statements after a return, break or continue can never run
+    for index, statement in enumerate(statements):
+        statements[index] = yield optimize_statement(statement)
+        if diverts(statements[index]):
+            del statements[index + 1:]
+            break
 
 
-def parse_tokens(tokens):
-    tree = parse_program(tokens)
-    return tree
+def optimize_statement(node):
+    if isinstance(node, CompoundNode):
+        yield optimize_statements(node.statements)
+        node.diverts = bool(node.statements) and diverts(node.statements[-1])
+        return node
+
+    if isinstance(node, DeclarationNode):
+        if hasattr(node, 'left') and not isinstance(node.left, leaf_nodes):
+            node.left = yield optimize_expression(node.left)
+        return node
+
+    if isinstance(node, ReturnNode):
+        if not isinstance(node.left, leaf_nodes):
+            node.left = yield optimize_expression(node.left)
+        return node
 
+    if isinstance(node, IfNode):
+        node.condition = yield optimize_expression(node.condition)
+        value = constant_value(node.condition)
+        if value is not None:
+            branch = node.true_branch if value != 0 else node.false_branch
+            return NullNode() if branch is None else (yield optimize_statement(branch))
+        node.true_branch = yield optimize_statement(node.true_branch)
+        if node.false_branch is not None:
+            node.false_branch = yield optimize_statement(node.false_branch)
+            node.diverts = diverts(node.true_branch) and diverts(node.false_branch)
+        return node
 
-def create_clause_label():
-    global clause_label_number
-    result = f"clause_{clause_label_number}"
-    clause_label_number += 1
-    return result
+    # a loop condition that is always true becomes a NullNode, which the
+    # generator compiles to a loop without a test
+    if isinstance(node, WhileNode) or isinstance(node, DoWhileNode):
+        node.condition = yield optimize_expression(node.condition)
+        value = constant_value(node.condition)
+        if value == 0 and isinstance(node, WhileNode):
+            return NullNode()
+        if value is not None and value != 0:
+            node.condition = NullNode()
+        node.body = yield optimize_statement(node.body)
+        return node
 
+    if isinstance(node, ForNode) or isinstance(node, ForDeclarationNode):
+        node.initial_expression = yield optimize_statement(node.initial_expression)
+        node.condition = yield optimize_expression(node.condition)
+        value = constant_value(node.condition)
+        if value == 0:
+            # only the initialisation is left
+            if isinstance(node, ForNode):
+                return node.initial_expression
+            block = CompoundNode()
+            block.statements.append(node.initial_expression)
+            return block
+        if value is not None:
+            node.condition = NullNode()
+        node.post_expression = yield optimize_expression(node.post_expression)
+        node.body = yield optimize_statement(node.body)
+        return node
 
-def create_end_label():
-    global clause_end_number
-    result = f"end_{clause_end_number}"
-    clause_end_number += 1
-    return result
+    if isinstance(node, (NullNode, BreakNode, ContinueNode)):
+        return node
 
+    return (yield optimize_expression(node))
 
-def create_false_branch_label():
-    global clause_false_branch_label
-    result = f"false_branch_{clause_false_branch_label}"
-    clause_false_branch_label += 1
-    return result
 
+def optimize_top_level_item(node):
+    if isinstance(node, FunctionNode):
+        yield optimize_statements(node.statements)
+        return node
+    return (yield optimize_statement(node))
 
-def create_post_conditional_number():
-    global clause_post_conditional_number
-    result = f"post_conditional_{clause_post_conditional_number}"
-    clause_post_conditional_number += 1
-    return result
 
+# Register allocation for locals and parameters at optimization level 1 and
+# above: a scan over the function body in code order gives every variable a
+# live range, and a linear scan assigns the ranges to callee saved registers.
+# When they run out the range with the lowest spill weight, its uses with
+# those inside loops counting ten times per loop level, goes to the stack, so
+# loop counters and accumulators keep their registers. A variable that is
+# never read gets no storage at all and the stores to it are dropped.
+allocatable_registers = ('%r12', '%r13', '%r14', '%r15')
 
-def create_clause_while_start_number():
-    global clause_while_start_number
-    result = f"while_start_{clause_while_start_number}"
-    clause_while_start_number += 1
-    return result
 
+class LiveRange:
+    def __init__(self, start):
+        self.start = start
+        self.end = start
+        self.used = False
+        self.read = False
+        self.weight = 0
+        self.location = None
 
-def create_clause_while_end_number():
-    global clause_while_end_number
-    result = f"while_end_{clause_while_end_number}"
-    clause_while_end_number += 1
-    return result
 
+class LivenessScan:
+    def __init__(self):
+        self.position = 0
+        self.symbols = SymbolTable()
+        self.ranges = []
+        # variables used in each loop being scanned, with the loop's start
+        self.loops = []
+
+    def declare(self, name):
+        live_range = LiveRange(self.position)
+        self.symbols.declare(name, live_range)
+        self.ranges.append(live_range)
+        return live_range
+
+    def use(self, name, read=True):
+        # returns the variable's range, None for a global
+        self.position += 1
+        live_range = self.symbols.symbols.get(name)
+        if live_range is None:
+            return None
+        live_range.end = self.position
+        live_range.used = True
+        live_range.read = live_range.read or read
+        live_range.weight += 10 ** min(len(self.loops), 6)
+        if self.loops:
+            self.loops[-1][1].add(live_range)
+        return live_range
+
+    def enter_loop(self):
+        self.loops.append((self.position, set()))
+
+    def leave_loop(self):
+        # a variable from before the loop that is used inside it has to live
+        # until the loop is left, the back edge may read it again
+        start, used = self.loops.pop()
+        for live_range in used:
+            if live_range.start < start:
+                live_range.end = max(live_range.end, self.position)
+        if self.loops:
+            self.loops[-1][1].update(used)
+
+
+def scan_expression(node, scan):
+    if isinstance(node, VariableNode):
+        scan.use(node.name)
+    elif isinstance(node, AssignNode):
+        yield scan_expression(node.left, scan)
+        node.live_range = scan.use(node.name, False)
+    elif isinstance(node, BinaryOperatorNode):
+        yield scan_expression(node.right, scan)
+        yield scan_expression(node.left, scan)
+    elif isinstance(node, UnaryOperatorNode):
+        yield scan_expression(node.left, scan)
+    elif isinstance(node, ConditionalNode):
+        yield scan_expression(node.condition, scan)
+        yield scan_expression(node.true_branch, scan)
+        yield scan_expression(node.false_branch, scan)
+    elif isinstance(node, FunctionCallNode):
+        for argument in node.args:
+            yield scan_expression(argument, scan)
 
-def create_clause_for_start_number():
-    global clause_for_start_number
-    result = f"for_start_{clause_for_start_number}"
-    clause_for_start_number += 1
-    return result
 
+def scan_statement(node, scan):
+    scan.position += 1
+    if isinstance(node, DeclarationNode):
+        if hasattr(node, 'left'):
+            yield scan_expression(node.left, scan)
+        node.live_range = scan.declare(node.name)
+    elif isinstance(node, CompoundNode):
+        scan.symbols.push_scope()
+        for statement in node.statements:
+            yield scan_statement(statement, scan)
+        scan.symbols.pop_scope()
+    elif isinstance(node, IfNode):
+        yield scan_expression(node.condition, scan)
+        yield scan_statement(node.true_branch, scan)
+        if node.false_branch is not None:
+            yield scan_statement(node.false_branch, scan)
+    elif isinstance(node, WhileNode):
+        scan.enter_loop()
+        yield scan_expression(node.condition, scan)
+        yield scan_statement(node.body, scan)
+        scan.leave_loop()
+    elif isinstance(node, DoWhileNode):
+        scan.enter_loop()
+        yield scan_statement(node.body, scan)
+        yield scan_expression(node.condition, scan)
+        scan.leave_loop()
+    elif isinstance(node, ForNode) or isinstance(node, ForDeclarationNode):
+        scan.symbols.push_scope()
+        yield scan_statement(node.initial_expression, scan)
+        scan.enter_loop()
+        yield scan_expression(node.condition, scan)
+        yield scan_statement(node.body, scan)
+        yield scan_expression(node.post_expression, scan)
+        scan.leave_loop()
+        scan.symbols.pop_scope()
+    elif isinstance(node, ReturnNode):
+        yield scan_expression(node.left, scan)
+    else:
+        yield scan_expression(node, scan)
 
-def create_clause_for_end_number():
-    global clause_for_end_number
-    result = f"for_end_{clause_for_end_number}"
-    clause_for_end_number += 1
-    return result
 
+def allocate_registers(node):
+    # gives every declaration in the function a live_range whose location is
+    # a register or None for a stack slot, returns the parameters' ranges and
+    # the callee saved registers the function has to preserve
+    scan = LivenessScan()
+    parameter_ranges = [scan.declare(name) for name in node.variables]
+    for statement in node.statements:
+        run_iteratively(scan_statement(statement, scan))
+
+    free_registers = list(reversed(allocatable_registers))
+    active = []
+    used_registers = set()
+    for live_range in scan.ranges:
+        if not live_range.read:
+            continue
+        for expired in [active_range for active_range in active if active_range.end < live_range.start]:
+            active.remove(expired)
+            free_registers.append(expired.location)
+        if free_registers:
+            live_range.location = free_registers.pop()
+        else:
+            spilled = min(active, key=lambda active_range: active_range.weight)
+            if spilled.weight >= live_range.weight:
+                continue
+            live_range.location = spilled.location
+            spilled.location = None
+            active.remove(spilled)
+        active.append(live_range)
+        used_registers.add(live_range.location)
 
-def create_clause_for_post_expression_number():
-    global clause_for_post_expression_number
-    result = f"for_post_expression_{clause_for_post_expression_number}"
-    clause_for_post_expression_number += 1
-    return result
+    return parameter_ranges, [register for register in allocatable_registers if register in used_registers]
 
 
 class Labels:
@@ -857,142 +1363,1097 @@ class Labels:
         self.post_expression_label = post_expression_label
 
 
+class SymbolTable:
+    # a single dict of the visible variables plus an undo log of what each
+    # declaration shadowed: entering a scope only records the log length and
+    # leaving it rolls the dict back to that point
+    missing = object()
+
+    def __init__(self):
+        self.symbols = {}
+        self.undo_log = []
+        self.scope_starts = []
+
+    def push_scope(self):
+        self.scope_starts.append(len(self.undo_log))
+
+    def pop_scope(self):
+        scope_start = self.scope_starts.pop()
+        undo_log = self.undo_log
+        symbols = self.symbols
+        while len(undo_log) > scope_start:
+            name, previous = undo_log.pop()
+            if previous is SymbolTable.missing:
+                del symbols[name]
+            else:
+                symbols[name] = previous
+
+    def declare(self, name, location):
+        self.undo_log.append((name, self.symbols.get(name, SymbolTable.missing)))
+        self.symbols[name] = location
+
+    def lookup(self, name):
+        return self.symbols[name]
+
+
+# caller saved registers used for intermediate results. %rax is the
+# accumulator. The first three double as the last argument registers, a call
+# being set up takes them out of the pool.
+scratch_registers = ('%rcx', '%r8', '%r9', '%r10')
+
+# reloads a spilled value, holds a divisor or the copy of the dividend a
+# division by a constant works with, only ever for the instructions that use
+# it. It is caller saved and never in the pool, so it is always free and
+# nothing has to be kept for it, unlike %rbx which the caller expects back.
+reload_register = '%r11'
+
+# System V: the first six arguments go in these, the rest on the stack
+argument_registers = ('%rdi', '%rsi', '%rdx', '%rcx', '%r8', '%r9')
+
+
 class Context:
-    def __init__(self, variables_data, labels, stack_index, current_scope, function_name):
-        self.variables_data = variables_data
+    def __init__(self, variables, labels, stack_index, function_name, session):
+        self.session = session
+        self.variables = variables
         self.labels = labels
         self.stack_index = stack_index
-        self.current_scope = current_scope
         self.function_name = function_name
         self.global_variables = {}
+        # scratch registers not holding an intermediate result right now, and
+        # the argument registers holding a value that is still needed: the
+        # parameters living there and the arguments of a call being set up
+        self.free_registers = list(scratch_registers)
+        self.argument_registers = ()
+        # bytes the prologue reserves below %rbp, and those pushed below them
+        # by the expression being evaluated
+        self.frame_size = 0
+        self.pushed = 0
 
 
-def generate(tree):
-    context = Context({}, Labels(None, None, None), 0, None, None)
+def stack_depth(context):
+    # bytes between %rbp and %rsp, known at every point of the function
+    return context.frame_size + context.pushed
 
-    result = ''
-    result += process_node(tree, result, context)
-    result += '\n'
-    return result
 
+# markers taking the place of the op in entries that are not instructions
+label_entry = ':'
+comment_entry = '#'
+text_entry = ''
 
-def process_node(node, result, context):
+
+class AsmEmitter:
+    # collects the assembly as a list of entries that is rendered once at the
+    # end: an instruction is the tuple (op, *operands), labels, comments and
+    # already rendered assembly are tagged with a marker in place of the op.
+    # Passes like the peephole optimizer rewrite the list before that.
+    def __init__(self):
+        self.entries = []
+
+    def emit_insn(self, op, *operands):
+        self.entries.append((op, *operands))
+
+    def emit_label(self, label):
+        self.entries.append((label_entry, label))
+
+    def emit_comment(self, text):
+        self.entries.append((comment_entry, text))
+
+    def emit_text(self, assembly):
+        self.entries.append((text_entry, assembly))
+
+    def getvalue(self):
+        return ''.join(map(render_entry, self.entries))
+
+    def flush(self, output_file):
+        # returns the number of characters written
+        assembly = self.getvalue()
+        output_file.write(assembly)
+        self.entries.clear()
+        return len(assembly)
+
+
+def render_entry(entry):
+    op = entry[0]
+    if op == text_entry:
+        return entry[1]
+    if op == label_entry:
+        return f"{entry[1]}:\n"
+    if op == comment_entry:
+        return f"\n#{entry[1]}\n"
+    if len(entry) > 1:
+        return f"    {op} {', '.join(entry[1:])}\n"
+    return f"    {op}\n"
+
+
+# Peephole optimizer, run over every function's entries at optimization level
+# 1 and above. A rule is called with the entries, the index of an instruction
+# whose op is one of its triggers and the successor list, which gives the
+# index of the next entry that is not a comment. It returns None or
+# (stop, replacement): the instructions from index up to stop are replaced,
+# comments among them are kept. The rules run until none of them matches.
+inverse_conditions = {'e': 'ne', 'ne': 'e', 'g': 'le', 'le': 'g', 'ge': 'l', 'l': 'ge'}
+rax_names = ('%rax', '%eax', '%al')
+zero_tests = (('cmp', '$0', '%rax'), ('test', '%rax', '%rax'))
+rax_zeroing = ('xor', '%eax', '%eax')
+
+# ops that read or write %rax without naming it, or leave the straight line
+implicit_rax_ops = {'cqo', 'idiv', 'idivq', 'imul', 'callq', 'ret', 'jmp'}
+
+# how far dead_rax_move looks for the next write of %rax
+dead_move_window = 8
+
+
+def successor_list(entries):
+    successors = [len(entries)] * (len(entries) + 1)
+    following = len(entries)
+    for index in range(len(entries) - 1, -1, -1):
+        successors[index] = following
+        if entries[index][0] != comment_entry:
+            following = index
+    return successors
+
+
+def mentions_rax(entry):
+    return any(operand in rax_names for operand in entry[1:])
+
+
+def peephole_push_pop(entries, index, successors):
+    # push X; pop Y  ->  movq X, Y
+    position = successors[index]
+    if position == len(entries) or entries[position][0] != 'pop':
+        return None
+    source = entries[index][1]
+    target = entries[position][1]
+    if '(' in source and '(' in target:
+        return None
+    if source == target:
+        return position + 1, []
+    return position + 1, [('movq', source, target)]
+
+
+def peephole_self_move(entries, index, successors):
+    # movq X, X
+    entry = entries[index]
+    if len(entry) == 3 and entry[1] == entry[2]:
+        return index + 1, []
+    return None
+
+
+def peephole_store_reload(entries, index, successors):
+    # movq %rax, M; movq M, %rax  ->  movq %rax, M
+    entry = entries[index]
+    if len(entry) != 3 or entry[1] != '%rax':
+        return None
+    position = successors[index]
+    if position == len(entries):
+        return None
+    reload = entries[position]
+    if reload[0] in ('movq', 'mov') and reload[1:] == (entry[2], '%rax'):
+        return position + 1, [entry]
+    return None
+
+
+def peephole_setcc_test(entries, index, successors):
+    # movq $0, %rax; setX %al; test %rax, %rax; je L  ->  movq $0, %rax; setX %al; jnX L
+    # the flags setX read are still those of the comparison
+    if entries[index][1:] != ('$0', '%rax'):
+        return None
+    test_position = successors[index]
+    compare_position = successors[test_position]
+    jump_position = successors[compare_position]
+    if jump_position >= len(entries):
+        return None
+    test = entries[test_position]
+    jump = entries[jump_position]
+    if not test[0].startswith('set') or test[1:] != ('%al',) or entries[compare_position] not in zero_tests:
+        return None
+    condition = test[0][3:]
+    if jump[0] == 'je':
+        jump_op = 'j' + inverse_conditions[condition]
+    elif jump[0] == 'jne':
+        jump_op = 'j' + condition
+    else:
+        return None
+    return jump_position + 1, [entries[index], test, (jump_op, jump[1])]
+
+
+def peephole_compare_zero(entries, index, successors):
+    # cmp $0, R  ->  test R, R, the same flags from a shorter instruction
+    entry = entries[index]
+    if entry[1] == '$0' and entry[2][0] == '%':
+        return index + 1, [('test', entry[2], entry[2])]
+    return None
+
+
+def peephole_jump_to_next(entries, index, successors):
+    # jmp L directly followed by the label L
+    target = (label_entry, entries[index][1])
+    position = successors[index]
+    while position < len(entries) and entries[position][0] == label_entry:
+        if entries[position] == target:
+            return index + 1, []
+        position = successors[position]
+    return None
+
+
+def peephole_unreachable_code(entries, index, successors):
+    # instructions between a jmp or ret and the next label never run
+    position = successors[index]
+    if position == len(entries) or entries[position][0] == label_entry or entries[position][0] == text_entry:
+        return None
+    while position < len(entries) and entries[position][0] != label_entry and entries[position][0] != text_entry:
+        position = successors[position]
+    return position, [entries[index]]
+
+
+def peephole_zero_stack_adjustment(entries, index, successors):
+    # add $0, %rsp
+    if entries[index][1:] == ('$0', '%rsp'):
+        return index + 1, []
+    return None
+
+
+def writes_rax(entry):
+    # movq X, %rax with X not %rax itself, or xor %eax, %eax
+    return entry == rax_zeroing or (entry[0] == 'movq' or entry[0] == 'mov') and entry[2] == '%rax' and \
+        entry[1] not in rax_names
+
+
+def peephole_dead_rax_move(entries, index, successors):
+    # movq X, %rax or xor %eax, %eax when %rax is written again before
+    # anything reads it
+    entry = entries[index]
+    if not writes_rax(entry):
+        return None
+    position = successors[index]
+    for _ in range(dead_move_window):
+        if position == len(entries):
+            return None
+        following = entries[position]
+        op = following[0]
+        if op == label_entry or op == text_entry or op in implicit_rax_ops or op[0] == 'j':
+            return None
+        if writes_rax(following):
+            return index + 1, []
+        if mentions_rax(following):
+            return None
+        position = successors[position]
+    return None
+
+
+# (name, trigger ops, rule), extended by appending
+peephole_rules = [
+    ('push_pop', ('push',), peephole_push_pop),
+    ('self_move', ('movq', 'mov'), peephole_self_move),
+    ('store_reload', ('movq', 'mov'), peephole_store_reload),
+    ('setcc_test', ('movq',), peephole_setcc_test),
+    ('compare_zero', ('cmp',), peephole_compare_zero),
+    ('jump_to_next', ('jmp',), peephole_jump_to_next),
+    ('unreachable_code', ('jmp', 'ret'), peephole_unreachable_code),
+    ('zero_stack_adjustment', ('add', 'sub'), peephole_zero_stack_adjustment),
+    ('dead_rax_move', ('movq', 'mov', 'xor'), peephole_dead_rax_move),
+]
+
+
+def optimize_peephole(entries, removed, rules=None):
+    # returns the rewritten entries, adds the instructions each rule removed
+    # to the removed dict. Labels no jump refers to go as well, symbols
+    # starting with an underscore are kept.
+    triggers = {}
+    for name, ops, rule in peephole_rules if rules is None else rules:
+        for op in ops:
+            triggers.setdefault(op, []).append((name, rule))
+
+    get_rules = triggers.get
+    changed = True
+    while changed:
+        changed = False
+        referenced = {entry[-1] for entry in entries if entry[0].startswith('j')}
+        kept = [entry for entry in entries
+                if entry[0] != label_entry or entry[1] in referenced or entry[1][0] == '_']
+        if len(kept) != len(entries):
+            removed['unreferenced_label'] = removed.get('unreferenced_label', 0) + len(entries) - len(kept)
+            entries = kept
+        successors = successor_list(entries)
+        result = []
+        append = result.append
+        index = 0
+        length = len(entries)
+        while index < length:
+            entry = entries[index]
+            candidates = get_rules(entry[0])
+            if candidates is not None:
+                for name, rule in candidates:
+                    match = rule(entries, index, successors)
+                    if match is not None:
+                        break
+                if match is not None:
+                    stop, replacement = match
+                    replaced = entries[index:stop]
+                    comments = [comment for comment in replaced if comment[0] == comment_entry]
+                    result.extend(replacement)
+                    result.extend(comments)
+                    removed[name] = removed.get(name, 0) + len(replaced) - len(comments) - len(replacement)
+                    index = stop
+                    changed = True
+                    continue
+            append(entry)
+            index += 1
+        entries = result
+    return entries
+
+
+compiler_version = '1.1'
+
+default_options = dict(
+    optimize=1,
+    stream=False,
+    codegen_jobs=1,
+    backend='ast',
+    dump_ir=False,
+    whole_program=False,
+    omit_frame_pointer=False,
+)
+
+# options that change how the output is produced but never what it is. The
+# stream option is not one of them: a function that is already written out
+# cannot be dropped when it turns out to be unused.
+output_neutral_options = {'codegen_jobs'}
+
+
+class CompileCache:
+    # content addressed store of generated assembly, one file per key under
+    # the cache directory. Hits bump the file's mtime, so the oldest mtimes
+    # are the least recently used entries and are evicted first once the
+    # directory grows past max_bytes.
+    fingerprint = None
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # running estimate of the directory size, the directory is only
+        # rescanned when it passes the cap
+        self.total_bytes = None
+
+    @staticmethod
+    def compiler_fingerprint():
+        # the version number plus the compiler's own source, so any change
+        # to the compiler invalidates earlier entries
+        if CompileCache.fingerprint is None:
+            digest = hashlib.sha256(compiler_version.encode())
+            with open(__file__, 'rb') as compiler_source:
+                digest.update(compiler_source.read())
+            CompileCache.fingerprint = digest.hexdigest()
+        return CompileCache.fingerprint
+
+    def new_digest(self, kind, options):
+        digest = hashlib.sha256(self.compiler_fingerprint().encode())
+        digest.update(kind.encode())
+        output_options = {name: value for name, value in options.items() if name not in output_neutral_options}
+        digest.update(json.dumps(output_options, sort_keys=True).encode())
+        return digest
+
+    def key(self, script, options):
+        digest = self.new_digest('file', options)
+        digest.update(script.encode() if isinstance(script, str) else script)
+        return digest.hexdigest()
+
+    def function_key(self, span, global_names, options):
+        # a function's assembly depends on its own tokens and on which globals
+        # it can see, labels are function local so nothing else leaks in
+        digest = self.new_digest('function', options)
+        digest.update(' '.join(sorted(global_names)).encode() + b'\0')
+        digest.update(span)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.asm')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r') as entry:
+                assembly = entry.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return assembly
+
+    @contextmanager
+    def store(self, key):
+        # the entry is written under a temporary name and only renamed into
+        # place once the compilation succeeded
+        temporary_path = f'{self.path(key)}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(temporary_path, 'w') as entry:
+                yield entry
+                size = entry.tell()
+            os.replace(temporary_path, self.path(key))
+        except BaseException:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            raise
+        if self.total_bytes is not None:
+            self.total_bytes += size
+        if self.total_bytes is None or self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def put(self, key, assembly):
+        with self.store(key) as entry:
+            entry.write(assembly)
+
+    def evict(self):
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as scanned:
+            for entry in scanned:
+                if not entry.name.endswith('.asm'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self.total_bytes = total_size
+
+
+class TeeWriter:
+    def __init__(self, *output_files):
+        self.output_files = output_files
+
+    def write(self, text):
+        for output_file in self.output_files:
+            output_file.write(text)
+
+
+def add_statistics(total, statistics):
+    # sums the counters of one session into another, per rule counts included
+    for name, value in statistics.items():
+        if isinstance(value, dict):
+            add_statistics(total.setdefault(name, {}), value)
+        else:
+            total[name] = total.get(name, 0) + value
+
+
+class CompilerSession:
+    # owns everything a compilation mutates besides its own tree: options,
+    # label numbering and statistics. Separate sessions can compile in
+    # parallel threads, and one session can compile many files in turn.
+    def __init__(self, cache=None, **options):
+        self.options = dict(default_options, **options)
+        self.cache = cache
+        self.label_numbers = {}
+        self.label_scope = None
+        self.statistics = dict(files=0, tokens=0, functions=0, globals=0, labels=0, assembly_bytes=0, seconds=0.0,
+                               cache_hits=0, cache_misses=0, function_hits=0, function_misses=0,
+                               functions_removed=0, globals_removed=0, stores_removed=0, peephole_removed={})
+
+    def new_context(self):
+        self.label_numbers = {}
+        self.label_scope = None
+        return Context(SymbolTable(), Labels(None, None, None), 0, None, self)
+
+    def begin_function(self, function_name):
+        # labels are numbered from zero in every function and carry its name,
+        # so a function's assembly does not depend on the functions before it
+        self.label_numbers = {}
+        self.label_scope = function_name
+
+    def new_label(self, kind):
+        number = self.label_numbers.get(kind, 0)
+        self.label_numbers[kind] = number + 1
+        self.statistics['labels'] += 1
+        return f"{kind}_{number}_{self.label_scope}"
+
+    def compile(self, script, output_file):
+        start = time.perf_counter()
+        if self.cache is None:
+            self.compile_uncached(script, output_file)
+        else:
+            key = self.cache.key(script, self.options)
+            assembly = self.cache.get(key)
+            if assembly is not None:
+                self.statistics['cache_hits'] += 1
+                self.statistics['assembly_bytes'] += len(assembly)
+                output_file.write(assembly)
+            else:
+                self.statistics['cache_misses'] += 1
+                with self.cache.store(key) as entry:
+                    self.compile_uncached(script, TeeWriter(output_file, entry))
+        self.statistics['files'] += 1
+        self.statistics['seconds'] += time.perf_counter() - start
+
+    def compile_uncached(self, script, output_file):
+        if self.options['stream']:
+            compile_stream(script, output_file, self)
+        else:
+            tokens = create_tokens(script)
+            self.statistics['tokens'] += len(tokens)
+            if self.cache is None and self.options['codegen_jobs'] <= 1:
+                output_file.write(generate(parse_tokens(tokens), self))
+            else:
+                output_file.write(generate_by_function(tokens, self))
+
+
+def generate(tree, session=None):
+    if session is None:
+        session = CompilerSession()
+    context = session.new_context()
+
+    out = AsmEmitter()
+    run_iteratively(process_node(tree, out, context))
+    assembly = out.getvalue() + '\n'
+    session.statistics['globals'] += len(context.global_variables)
+    session.statistics['assembly_bytes'] += len(assembly)
+    return assembly
+
+
+def top_level_item_end(kinds, first):
+    # index just past the item starting at first: the `;` of a declaration or
+    # prototype, or the brace closing a function body
+    depth = 0
+    for index in range(first, len(kinds)):
+        kind = kinds[index]
+        if kind == TokenKind.open_brace:
+            depth += 1
+        elif kind == TokenKind.close_brace:
+            depth -= 1
+            if depth <= 0:
+                return index + 1
+        elif kind == TokenKind.semi_colon and depth == 0:
+            return index + 1
+    return len(kinds)
+
+
+# Functions other than main are not exported, so one that main can never
+# reach is left out of the assembly. Whole program mode also leaves out the
+# global variables, which are exported, that no remaining function mentions.
+# Reachability is decided on the functions as written, before any of them is
+# optimised, so the whole file and the per function paths agree without the
+# latter having to parse every function.
+child_attributes = ('left', 'right', 'condition', 'true_branch', 'false_branch', 'initial_expression',
+                    'post_expression', 'body')
+
+
+def tree_references(tree):
+    # ({function: (names it calls, names it mentions)}, global names) of the
+    # function definitions and global declarations in a ProgramNode
+    references = {}
+    global_names = []
+    for item in tree.top_level_items:
+        if isinstance(item, DeclarationNode):
+            global_names.append(item.name)
+        if not isinstance(item, FunctionNode):
+            continue
+        calls, names = references.setdefault(item.name, (set(), set()))
+        names.update(item.variables)
+        stack = list(item.statements)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, FunctionCallNode):
+                calls.add(node.name)
+                stack.extend(node.args)
+                continue
+            if isinstance(node, (VariableNode, AssignNode, DeclarationNode)):
+                names.add(node.name)
+            elif isinstance(node, CompoundNode):
+                stack.extend(node.statements)
+            for attribute in child_attributes:
+                child = getattr(node, attribute, None)
+                if child is not None:
+                    stack.append(child)
+    return references, global_names
+
+
+def token_references(tokens):
+    # the same as tree_references, read off the tokens: inside a function an
+    # identifier followed by ( is a call and any other one names a variable
+    references = {}
+    global_names = []
+    kinds = tokens.kinds
+    first = 0
+    while first + 2 < len(kinds) and kinds[first] == TokenKind.int_keyword:
+        end = top_level_item_end(kinds, first)
+        if kinds[first + 2] != TokenKind.open_parenthesis:
+            global_names.append(tokens.value(first + 1))
+        elif kinds[end - 1] == TokenKind.close_brace:
+            calls, names = references.setdefault(tokens.value(first + 1), (set(), set()))
+            for index in range(first + 3, end):
+                if kinds[index] == TokenKind.identifier:
+                    if kinds[index + 1] == TokenKind.open_parenthesis:
+                        calls.add(tokens.value(index))
+                    else:
+                        names.add(tokens.value(index))
+        first = end
+    return references, global_names
+
+
+def unused_names(references, global_names, whole_program):
+    # the functions main does not reach and, in whole program mode, the
+    # globals none of the others mention. Without a main nothing is unused.
+    if 'main' not in references:
+        return set()
+    reached = {'main'}
+    pending = ['main']
+    while pending:
+        for callee in references[pending.pop()][0]:
+            if callee in references and callee not in reached:
+                reached.add(callee)
+                pending.append(callee)
+    unused = set(references) - reached
+    if whole_program:
+        mentioned = set()
+        for name in reached:
+            mentioned.update(references[name][1])
+        unused.update(name for name in global_names if name not in mentioned)
+    return unused
+
+
+def is_unused(item, unused, statistics):
+    # counts what it leaves out
+    if isinstance(item, FunctionNode) and item.name in unused:
+        statistics['functions_removed'] += 1
+        return True
+    if isinstance(item, DeclarationNode) and item.name in unused:
+        statistics['globals_removed'] += 1
+        return True
+    return False
+
+
+# the failures of a parallel compile the serial path is rerun for: a worker
+# counts the position of a syntax error from the start of its function, not
+# of the file, and a pool that cannot start, loses a worker or cannot pickle
+# says nothing about the source. Any other error is raised as it is.
+parallel_fallback_errors = (SyntaxError, BrokenExecutor, pickle.PicklingError, OSError)
+
+
+def generate_by_function(tokens, session):
+    # like generate(parse_tokens(tokens)), but every function is handled on
+    # its own: one whose tokens and visible globals are unchanged since an
+    # earlier compile is copied from the cache without being parsed, and with
+    # codegen_jobs > 1 the rest are parsed and generated in worker processes.
+    # Labels are function local, so the fragments are spliced back in source
+    # order and give the same assembly as the serial path.
+    if session.options['codegen_jobs'] > 1:
+        # what the parallel attempt counted is undone before the serial rerun
+        # counts it again
+        statistics = {}
+        add_statistics(statistics, session.statistics)
+        try:
+            return generate_functions_in_parallel(tokens, session)
+        except parallel_fallback_errors:
+            session.statistics.clear()
+            session.statistics.update(statistics)
+    return generate_functions(tokens, session)
+
+
+def generate_functions(tokens, session, pending=None):
+    # with a pending list, functions missing from the cache are not generated
+    # but left as a text entry of None in the output and appended to pending
+    # as (entry index, span, visible globals, cache key)
+    cache = session.cache
+    statistics = session.statistics
+    cursor = TokenCursor(tokens)
+    context = session.new_context()
+    out = AsmEmitter()
+    unused = set()
+    if session.options['optimize'] >= 1:
+        unused = unused_names(*token_references(tokens), session.options['whole_program'])
+
+    out.emit_insn('.globl', '_main')
+    while True:
+        first = cursor.index
+        if cursor.peek() != TokenKind.int_keyword or cursor.peek(2) != TokenKind.open_parenthesis:
+            item = run_iteratively(parse_top_level_item(cursor))
+            if not is_unused(item, unused, statistics):
+                run_iteratively(process_node(item, out, context))
+        else:
+            end = top_level_item_end(cursor.kinds, first)
+            if cursor.kinds[end - 1] == TokenKind.close_brace and tokens.value(first + 1) in unused:
+                statistics['functions_removed'] += 1
+                cursor.index = end
+            else:
+                key = None
+                assembly = None
+                if cache is not None:
+                    key = cache.function_key(tokens.span_bytes(first, end), context.global_variables, session.options)
+                    assembly = cache.get(key)
+                if assembly is not None:
+                    statistics['function_hits'] += 1
+                    statistics['functions'] += 1
+                    cursor.index = end
+                elif pending is not None:
+                    pending.append((len(out.entries), tokens.span_bytes(first, end), tuple(context.global_variables),
+                                    key))
+                    cursor.index = end
+                else:
+                    if cache is not None:
+                        statistics['function_misses'] += 1
+                    function_out = AsmEmitter()
+                    item = run_iteratively(parse_top_level_item(cursor))
+                    run_iteratively(process_node(item, function_out, context))
+                    assembly = function_out.getvalue()
+                    if cache is not None and cursor.index == end:
+                        cache.put(key, assembly)
+                out.emit_text(assembly)
+        if cursor.peek() != TokenKind.int_keyword:
+            break
+
+    generate_data_section(out, context)
+    if pending is not None:
+        return out, context
+    assembly = out.getvalue() + '\n'
+    statistics['globals'] += len(context.global_variables)
+    statistics['assembly_bytes'] += len(assembly)
+    return assembly
+
+
+def generate_functions_in_parallel(tokens, session):
+    pending = []
+    out, context = generate_functions(tokens, session, pending)
+
+    jobs = session.options['codegen_jobs']
+    options = dict(session.options, codegen_jobs=1)
+    chunk_size = max(1, len(pending) // (jobs * 4))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(generate_function, [span for _, span, _, _ in pending],
+                               [global_names for _, _, global_names, _ in pending], repeat(options),
+                               chunksize=chunk_size)
+        for (entry_index, _, _, key), (assembly, statistics) in zip(pending, results):
+            out.entries[entry_index] = (text_entry, assembly)
+            add_statistics(session.statistics, statistics)
+            if key is not None:
+                session.statistics['function_misses'] += 1
+                session.cache.put(key, assembly)
+
+    assembly = out.getvalue() + '\n'
+    session.statistics['globals'] += len(context.global_variables)
+    session.statistics['assembly_bytes'] += len(assembly)
+    return assembly
+
+
+def generate_function(span, global_names, options):
+    # runs in a worker: parses and generates a single function given its
+    # source text and the globals declared before it
+    session = CompilerSession(**options)
+    context = session.new_context()
+    for name in global_names:
+        context.variables.declare(name, f"_{name}(%rip)")
+
+    tokens = TokenCursor(create_tokens(span))
+    item = run_iteratively(parse_top_level_item(tokens))
+    if tokens.peek() != TokenKind.end_of_input:
+        raise tokens.error('end of function expected')
+    out = AsmEmitter()
+    run_iteratively(process_node(item, out, context))
+    return out.getvalue(), session.statistics
+
+
+def process_node(node, out, context):
     if isinstance(node, ProgramNode):
-        result += '    .globl	_main\n'
+        out.emit_insn('.globl', '_main')
+        unused = set()
+        if context.session.options['optimize'] >= 1:
+            unused = unused_names(*tree_references(node), context.session.options['whole_program'])
         for statement in node.top_level_items:
-            result = process_node(statement, result, context)
+            if not is_unused(statement, unused, context.session.statistics):
+                yield process_node(statement, out, context)
 
-        result += '.section	data\n'
-        for variable_name in context.global_variables:
-            result += f"    .globl _{variable_name}\n"
-            result += f"    .p2align 4\n"
-            result += f"_{variable_name}:\n"
-            result += f"    .long {context.global_variables[variable_name]}\n"
+        generate_data_section(out, context)
 
     elif isinstance(node, FunctionNode):
-        result = process_function(node, result, context)
+        if context.session.options['optimize'] >= 1:
+            node = yield optimize_top_level_item(node)
+        if context.session.options['backend'] == 'ir':
+            yield generate_function_from_ir(node, out, context)
+        else:
+            yield process_function(node, out, context)
     elif isinstance(node, DeclarationNode):
-        result = generate_declaration(node, result, context)
+        if context.session.options['optimize'] >= 1:
+            node = yield optimize_top_level_item(node)
+        yield generate_declaration(node, out, context)
     else:
-        result = process_expression(node, result, context)
+        yield process_expression(node, out, context)
+
 
-    return result
+def generate_data_section(out, context):
+    out.emit_insn('.section', 'data')
+    for variable_name in context.global_variables:
+        out.emit_insn('.globl', f"_{variable_name}")
+        out.emit_insn('.p2align', '4')
+        out.emit_label(f"_{variable_name}")
+        out.emit_insn('.long', f"{context.global_variables[variable_name]}")
 
 
-def generate_declaration(node, result, context):
+def compile_stream(script, output_file, session=None):
+    # parses one top-level item at a time, generates it and writes it out
+    # before reading the next one, so neither the token buffer nor the tree
+    # ever holds more than one function
+    if session is None:
+        session = CompilerSession()
+    tokens = TokenCursor(create_token_stream(script))
+    context = session.new_context()
+    out = AsmEmitter()
+
+    out.emit_insn('.globl', '_main')
+    while True:
+        item = run_iteratively(parse_top_level_item(tokens))
+        tokens.release()
+        run_iteratively(process_node(item, out, context))
+        session.statistics['assembly_bytes'] += out.flush(output_file)
+        if tokens.peek() != TokenKind.int_keyword:
+            break
+
+    generate_data_section(out, context)
+    out.emit_text('\n')
+    session.statistics['assembly_bytes'] += out.flush(output_file)
+
+    session.statistics['tokens'] += tokens.tokens.released + len(tokens.tokens)
+    session.statistics['globals'] += len(context.global_variables)
+
+
+def generate_declaration(node, out, context):
 
     if context.stack_index == 0:
-        context.variables_data[node.name] = f"_{node.name}(%rip)"
+        context.variables.declare(node.name, f"_{node.name}(%rip)")
         if hasattr(node, 'left'):
             context.global_variables[node.name] = node.left.value
         else:
             if node.name not in context.global_variables:
                 context.global_variables[node.name] = 0
+        # the value goes in the data section, there is no code to run
+        return
 
-    elif context.current_scope is None:
-        context.variables_data[node.name] = f"{context.stack_index}(%rbp)"
-        context.stack_index = context.stack_index - 8
-    else:
-        context.current_scope[node.name] = f"{context.stack_index}(%rbp)"
-        context.stack_index = context.stack_index - 8
+    elif hasattr(node, 'live_range') and not node.live_range.read:
+        # never read, only an initialiser with side effects is left
+        if hasattr(node, 'left'):
+            context.session.statistics['stores_removed'] += 1
+            if not is_pure(node.left):
+                yield process_expression(node.left, out, context)
+        context.variables.declare(node.name, None)
+        return
+
+    elif hasattr(node, 'live_range') and node.live_range.location is not None:
+        # kept in a register by allocate_registers, nothing to allocate
+        location = node.live_range.location
+        out.emit_comment("Declaration start")
+        if hasattr(node, 'left'):
+            yield generate_store(node.left, location, out, context)
+        context.variables.declare(node.name, location)
+        out.emit_comment("Declaration end")
+        return
 
-    result += f"#Declaration start\n"
-    result += f"    push %rax\n"
+    # the next slot of the frame, the prologue has reserved it
+    location = f"{context.stack_index}(%rbp)"
+    context.variables.declare(node.name, location)
+    context.stack_index = context.stack_index - 8
 
+    out.emit_comment("Declaration start")
     if hasattr(node, 'left'):
-        result = process_expression(node.left, result, context)
-        result += f"    movq %rax, {context.stack_index + 8}(%rbp)\n\n"
-
-    result += f"#Declaration end\n"
+        if context.session.options['optimize'] >= 1:
+            yield generate_store(node.left, location, out, context)
+        else:
+            yield process_expression(node.left, out, context)
+            out.emit_insn('movq', '%rax', location)
+    out.emit_comment("Declaration end")
 
-    return result
 
+# Frame layout: before a function is generated a pass over its body works
+# out the most stack slots its locals hold at the same time. Blocks that are
+# never active together share their slots, the prologue reserves them all
+# with one sub and nothing adjusts %rsp until the epilogue.
+def needs_stack_slot(node):
+    # every local at -O0, at -O1 those that are read but got no register
+    live_range = getattr(node, 'live_range', None)
+    return live_range is None or live_range.read and live_range.location is None
 
-def process_function(node, result, context):
 
-    new_context = copy.deepcopy(context)
+def block_slots(statements):
+    declared = deepest = 0
+    for statement in statements:
+        slots = yield statement_slots(statement)
+        if isinstance(statement, DeclarationNode):
+            declared += slots
+            deepest = max(deepest, declared)
+        else:
+            deepest = max(deepest, declared + slots)
+    return deepest
+
+
+def statement_slots(node):
+    # the most stack slots the locals declared in node hold at once
+    if isinstance(node, DeclarationNode):
+        return 1 if needs_stack_slot(node) else 0
+    if isinstance(node, CompoundNode):
+        return (yield block_slots(node.statements))
+    if isinstance(node, IfNode):
+        true_slots = yield statement_slots(node.true_branch)
+        false_slots = 0
+        if node.false_branch is not None:
+            false_slots = yield statement_slots(node.false_branch)
+        return max(true_slots, false_slots)
+    if isinstance(node, ForDeclarationNode):
+        declared = yield statement_slots(node.initial_expression)
+        return declared + (yield statement_slots(node.body))
+    if isinstance(node, (WhileNode, DoWhileNode, ForNode)):
+        return (yield statement_slots(node.body))
+    return 0
+
+
+def makes_calls(node):
+    stack = list(node.statements)
+    while stack:
+        current = stack.pop()
+        if isinstance(current, FunctionCallNode):
+            return True
+        if isinstance(current, CompoundNode):
+            stack.extend(current.statements)
+        for attribute in child_attributes:
+            child = getattr(current, attribute, None)
+            if child is not None:
+                stack.append(child)
+    return False
+
+
+def process_function(node, out, context):
+
+    context.variables.push_scope()
 
     function_name = node.name
 
-    new_context.function_name = function_name
+    context.function_name = function_name
+    context.session.begin_function(function_name)
+    context.session.statistics['functions'] += 1
 
-    result += f"_{function_name}:\n"
-    result += f"    push %rbp\n"
-    result += f"    movq %rsp, %rbp\n"
-    result += f"    movq $0, %rax\n\n"
+    if context.session.options['optimize'] >= 1:
+        parameter_ranges, saved_registers = allocate_registers(node)
+    else:
+        parameter_ranges, saved_registers = None, []
 
     variables = node.variables
-    if len(variables) > 0:
-        new_context.variables_data[variables[0]] = "%rdi"
-    if len(variables) > 1:
-        new_context.variables_data[variables[1]] = "%rsi"
-    if len(variables) > 2:
-        new_context.variables_data[variables[2]] = "%rdx"
-
-    new_context.stack_index = -8
+    # where the caller puts each parameter, past the sixth above the return
+    # address
+    homes = list(argument_registers[:len(variables)])
+    homes += [f"{16 + 8 * index}(%rbp)" for index in range(len(variables) - len(homes))]
+
+    # a parameter passed in a register that is read but got no register of
+    # its own takes a slot, as do the locals
+    slots = run_iteratively(block_slots(node.statements))
+    if parameter_ranges is not None:
+        slots += sum(1 for home, live_range in zip(homes, parameter_ranges)
+                     if home[0] == '%' and live_range.read and live_range.location is None)
+    frame_size = 8 * (len(saved_registers) + slots)
+    calls = makes_calls(node)
+    if calls:
+        # a call then finds %rsp aligned unless it is in the middle of pushes
+        frame_size += frame_size % 16
+    omit_frame = context.session.options['omit_frame_pointer'] and not calls and not slots and \
+        len(variables) <= len(argument_registers)
+
+    function_start = len(out.entries)
+    out.emit_label(f"_{function_name}")
+    if not omit_frame:
+        out.emit_insn('push', '%rbp')
+        out.emit_insn('movq', '%rsp', '%rbp')
+    for register in saved_registers:
+        out.emit_insn('push', register)
+    if frame_size > 8 * len(saved_registers):
+        out.emit_insn('sub', f"${frame_size - 8 * len(saved_registers)}", '%rsp')
+    if context.session.options['optimize'] >= 1:
+        zero_register('%rax', out)
+    else:
+        out.emit_insn('movq', '$0', '%rax')
+
+    context.stack_index = -8 - 8 * len(saved_registers)
+    context.frame_size = frame_size
+    context.pushed = 0
+    if parameter_ranges is None:
+        for name, home in zip(variables, homes):
+            context.variables.declare(name, home)
+        context.argument_registers = argument_registers[:len(variables)]
+    else:
+        # parameters move to their allocated register or a stack slot, which
+        # leaves the argument registers free for the calls this function makes
+        for name, home, live_range in zip(variables, homes, parameter_ranges):
+            if not live_range.read:
+                context.variables.declare(name, home)
+            elif live_range.location is not None:
+                out.emit_insn('movq', home, live_range.location)
+                context.variables.declare(name, live_range.location)
+            elif home[0] != '%':
+                # passed on the stack, it already has a slot
+                context.variables.declare(name, home)
+            else:
+                out.emit_insn('movq', home, f"{context.stack_index}(%rbp)")
+                context.variables.declare(name, f"{context.stack_index}(%rbp)")
+                context.stack_index -= 8
 
     for statement in node.statements:
         if isinstance(statement, DeclarationNode):
-            result = generate_declaration(
-                statement, result, new_context)
+            yield generate_declaration(statement, out, context)
 
         else:
-            result, new_context = generate_statement(
-                statement, result,  new_context)
+            yield generate_statement(statement, out, context)
+
+    out.emit_label(f"end_label_{context.function_name}")
+    if omit_frame:
+        # %rsp is back where the saved registers were pushed
+        for register in reversed(saved_registers):
+            out.emit_insn('pop', register)
+    else:
+        for index, register in enumerate(saved_registers):
+            out.emit_insn('movq', f"{-8 * (index + 1)}(%rbp)", register)
+        out.emit_insn('movq', '%rbp', '%rsp')
+        out.emit_insn('pop', '%rbp')
+    out.emit_insn('ret')
 
-    result += f"\nend_label_{new_context.function_name}:\n"
-    result += f"    movq %rbp, %rsp\n"
-    result += f"    pop %rbp\n"
-    result += f"    ret\n"
+    if context.session.options['optimize'] >= 1:
+        out.entries[function_start:] = optimize_peephole(out.entries[function_start:],
+                                                         context.session.statistics['peephole_removed'])
 
-    return result
+    context.variables.pop_scope()
+    context.stack_index = 0
+    context.frame_size = 0
+    context.function_name = None
+    context.argument_registers = ()
 
 
-def generate_block(block, result, context):
-    new_context = copy.deepcopy(context)
-    new_context.current_scope = {}
+def generate_block(block, out, context):
+    context.variables.push_scope()
+    stack_index = context.stack_index
 
     for statement in block.statements:
         if isinstance(statement,   DeclarationNode):
-            result = generate_declaration(
-                statement, result, new_context)
+            yield generate_declaration(statement, out, context)
         else:
-            new_variables_data = new_context.variables_data | new_context.current_scope
-            new_context.variables_data = new_variables_data
-            result, new_context = generate_statement(
-                statement, result, new_context)
+            yield generate_statement(statement, out, context)
 
-    bytes_to_deallocate = 8 * len(new_context.current_scope)
-    result += f"    add ${bytes_to_deallocate}, %rsp\n"
-    return result, context
+    # the slots of the block's locals are free for the blocks after it
+    context.variables.pop_scope()
+    context.stack_index = stack_index
 
 
-def generate_statement(block, result, context):
+def generate_statement(block, out, context):
     if isinstance(block, NullNode):
-        return result, context
+        return
     if isinstance(block, WhileNode):
-        while_start_label = create_clause_while_start_number()
-        while_end_label = create_clause_while_end_number()
+        while_start_label = context.session.new_label('while_start')
+        while_end_label = context.session.new_label('while_end')
 
         previous_start_label = context.labels.start_label
         previous_end_label = context.labels.end_label
@@ -1002,29 +2463,28 @@ def generate_statement(block, result, context):
         context.labels.end_label = while_end_label
         context.labels.post_expression_label = while_start_label
 
-        result += f"\n#While condition start\n\n"
+        out.emit_comment("While condition start")
 
-        result += f"{while_start_label}:\n"
-        result = process_expression(block.condition, result, context)
-        result += f"    cmp $0, %rax\n"
-        result += f"    je {while_end_label}\n"
-        result += f"\n#While condition end\n\n"
+        out.emit_label(while_start_label)
+        if not isinstance(block.condition, NullNode):
+            yield generate_branch(block.condition, while_end_label, False, out, context)
+        out.emit_comment("While condition end")
 
-        result += f"\n#While body start\n\n"
-        result, context = generate_statement(block.body, result, context)
+        out.emit_comment("While body start")
+        yield generate_statement(block.body, out, context)
 
-        result += f"    jmp {while_start_label}\n"
-        result += f"{while_end_label}:\n"
-        result += f"\n#While body end\n\n"
+        out.emit_insn('jmp', while_start_label)
+        out.emit_label(while_end_label)
+        out.emit_comment("While body end")
 
         context.labels.start_label = previous_start_label
         context.labels.end_label = previous_end_label
         context.labels.post_expression_label = previous_post_expression_label
 
-        return result, context
+        return
     if isinstance(block, DoWhileNode):
-        while_start_label = create_clause_while_start_number()
-        while_end_label = create_clause_while_end_number()
+        while_start_label = context.session.new_label('while_start')
+        while_end_label = context.session.new_label('while_end')
 
         previous_start_label = context.labels.start_label
         previous_end_label = context.labels.end_label
@@ -1034,23 +2494,25 @@ def generate_statement(block, result, context):
         context.labels.end_label = while_end_label
         context.labels.post_expression_label = while_start_label
 
-        result += f"{while_start_label}:\n"
-        result, context = generate_statement(block.body, result, context)
+        out.emit_label(while_start_label)
+        yield generate_statement(block.body, out, context)
 
-        result = process_expression(block.condition, result, context)
-        result += f"    cmp $0, %rax\n"
-        result += f"    jne {while_start_label}\n"
+        if isinstance(block.condition, NullNode):
+            out.emit_insn('jmp', while_start_label)
+        else:
+            yield generate_branch(block.condition, while_start_label, True, out, context)
+        out.emit_label(while_end_label)
 
         context.labels.start_label = previous_start_label
         context.labels.end_label = previous_end_label
         context.labels.post_expression_label = previous_post_expression_label
 
-        return result, context
+        return
 
     if isinstance(block, ForNode):
-        for_start_label = create_clause_for_start_number()
-        for_end_label = create_clause_for_end_number()
-        for_post_expression_label = create_clause_for_post_expression_number()
+        for_start_label = context.session.new_label('for_start')
+        for_end_label = context.session.new_label('for_end')
+        for_post_expression_label = context.session.new_label('for_post_expression')
 
         previous_start_label = context.labels.start_label
         previous_end_label = context.labels.end_label
@@ -1060,335 +2522,1519 @@ def generate_statement(block, result, context):
         context.labels.end_label = for_end_label
         context.labels.post_expression_label = for_post_expression_label
 
-        result += '\n'
-        result = process_expression(block.initial_expression, result, context)
-        result += f"\n{for_start_label}:\n"
+        yield generate_expression_statement(block.initial_expression, out, context)
+        out.emit_label(for_start_label)
 
-        if isinstance(block.condition, NullNode):
-            result += f"    movq $1, %rax\n"
-        else:
-            result = process_expression(block.condition, result, context)
+        if not isinstance(block.condition, NullNode):
+            yield generate_branch(block.condition, for_end_label, False, out, context)
 
-        result += f"    cmp $0, %rax\n"
-        result += f"    je {for_end_label}\n\n"
+        yield generate_statement(block.body, out, context)
 
-        result, context = generate_statement(block.body, result, context)
-        result += '\n'
+        out.emit_label(for_post_expression_label)
+        yield generate_expression_statement(block.post_expression, out, context)
+        out.emit_insn('jmp', for_start_label)
 
-        result += f"{for_post_expression_label}: "
-        result = process_expression(block.post_expression, result, context)
-        result += f"    jmp {for_start_label}\n"
-
-        result += f"{for_end_label}:\n\n"
+        out.emit_label(for_end_label)
 
         context.labels.start_label = previous_start_label
         context.labels.end_label = previous_end_label
         context.labels.post_expression_label = previous_for_post_expression_label
 
-        return result, context
+        return
 
     if isinstance(block, ForDeclarationNode):
-        new_context = copy.deepcopy(context)
-        new_context.current_scope = {}
-        for_start_label = create_clause_for_start_number()
-        for_end_label = create_clause_for_end_number()
-        for_post_expression_label = create_clause_for_post_expression_number()
-
-        previous_start_label = new_context.labels.start_label
-        previous_end_label = new_context.labels.end_label
-        previous_for_post_expression_label = new_context.labels.post_expression_label
+        context.variables.push_scope()
+        stack_index = context.stack_index
+        for_start_label = context.session.new_label('for_start')
+        for_end_label = context.session.new_label('for_end')
+        for_post_expression_label = context.session.new_label('for_post_expression')
 
-        new_context.labels.start_label = for_start_label
-        new_context.labels.end_label = for_end_label
-        new_context.labels.post_expression_label = for_post_expression_label
-
-        result += '\n'
-        result = generate_declaration(
-            block.initial_expression, result, new_context)
-        result += f"\n#For condition start\n"
+        previous_start_label = context.labels.start_label
+        previous_end_label = context.labels.end_label
+        previous_for_post_expression_label = context.labels.post_expression_label
 
-        new_variables_data = new_context.variables_data | new_context.current_scope
-        new_context.variables_data = new_variables_data
+        context.labels.start_label = for_start_label
+        context.labels.end_label = for_end_label
+        context.labels.post_expression_label = for_post_expression_label
 
-        result += f"\n{for_start_label}:\n"
+        yield generate_declaration(block.initial_expression, out, context)
+        out.emit_comment("For condition start")
 
-        if isinstance(block.condition, NullNode):
-            result += f"    movq $1, %rax\n"
-        else:
-            result = process_expression(block.condition, result, new_context)
+        out.emit_label(for_start_label)
 
-        result += f"    cmp $0, %rax\n"
-        result += f"    je {for_end_label}\n\n"
-        result += f"#For condition end\n"
+        if not isinstance(block.condition, NullNode):
+            yield generate_branch(block.condition, for_end_label, False, out, context)
+        out.emit_comment("For condition end")
 
-        result += f"\n#For body start\n"
-        result, new_context = generate_statement(
-            block.body, result, new_context)
-        result += '\n'
+        out.emit_comment("For body start")
+        yield generate_statement(block.body, out, context)
 
-        result += f"#For body end\n"
+        out.emit_comment("For body end")
 
-        result += f"\n#For post_expression start\n"
-        result += f"{for_post_expression_label}:\n"
-        result = process_expression(block.post_expression, result, new_context)
-        result += f"    jmp {for_start_label}\n"
-        result += f"#For post_expression end\n"
+        out.emit_comment("For post_expression start")
+        out.emit_label(for_post_expression_label)
+        yield generate_expression_statement(block.post_expression, out, context)
+        out.emit_insn('jmp', for_start_label)
+        out.emit_comment("For post_expression end")
 
-        result += f"{for_end_label}:\n\n"
+        out.emit_label(for_end_label)
 
-        bytes_to_deallocate = 8 * len(new_context.current_scope)
-        result += f"    add ${bytes_to_deallocate}, %rsp\n"
+        context.labels.start_label = previous_start_label
+        context.labels.end_label = previous_end_label
+        context.labels.post_expression_label = previous_for_post_expression_label
 
-        new_context.labels.start_label = previous_start_label
-        new_context.labels.end_label = previous_end_label
-        new_context.labels.post_expression_label = previous_for_post_expression_label
+        context.variables.pop_scope()
+        context.stack_index = stack_index
 
-        return result, context
+        return
     if isinstance(block, CompoundNode):
-        result, context = generate_block(
-            block, result, context)
+        yield generate_block(block, out, context)
     elif isinstance(block, IfNode):
-        result += "\n#If condition  start\n\n"
-
-        result = process_expression(block.condition, result, context)
-        result += f"    cmp $0, %rax\n"
-        false_branch_label = create_false_branch_label()
-        post_conditional__label = create_post_conditional_number()
-        result += f"    je {false_branch_label}\n"
-        result += "\n#If true branch  start\n\n"
-        result, context = generate_statement(
-            block.true_branch, result, context)
-        result += f"    jmp {post_conditional__label}\n"
-        result += f"{false_branch_label}:\n"
+        out.emit_comment("If condition  start")
+
+        false_branch_label = context.session.new_label('false_branch')
+        post_conditional__label = context.session.new_label('post_conditional')
+        yield generate_branch(block.condition, false_branch_label, False, out, context)
+        out.emit_comment("If true branch  start")
+        yield generate_statement(block.true_branch, out, context)
+        if context.session.options['optimize'] < 1 or not diverts(block.true_branch):
+            out.emit_insn('jmp', post_conditional__label)
+        out.emit_label(false_branch_label)
 
         if block.false_branch is not None:
-            result += "\n#If false branch  start\n\n"
-            result, context = generate_statement(
-                block.false_branch, result, context)
+            out.emit_comment("If false branch  start")
+            yield generate_statement(block.false_branch, out, context)
 
-        result += f"{post_conditional__label}:\n"
+        out.emit_label(post_conditional__label)
     else:
-        result = process_expression(block, result,  context)
+        yield generate_expression_statement(block, out, context)
+
+
+def generate_expression_statement(node, out, context):
+    # an expression evaluated for its side effects only, at -O1 an
+    # assignment then does not need to leave its value in %rax
+    if isinstance(node, AssignNode) and context.session.options['optimize'] >= 1:
+        live_range = getattr(node, 'live_range', None)
+        if live_range is None or live_range.read:
+            out.emit_comment("Assignment start")
+            yield generate_assignment(node, out, context)
+            out.emit_comment("Assignment end")
+            return
+    yield process_expression(node, out, context)
+
+
+def generate_assignment(node, out, context):
+    # x = x + e, x = x - e, x = -x and x = ~x update x in place, anything
+    # else is stored straight into the variable
+    variable = context.variables.lookup(node.name)
+    value = node.left
+    if isinstance(value, UnaryOperatorNode) and value.name in unary_update_instructions and \
+            isinstance(value.left, VariableNode) and value.left.name == node.name:
+        op = unary_update_instructions[value.name]
+        out.emit_insn(op if variable[0] == '%' else op + 'q', variable)
+        return
+    other = None
+    if isinstance(value, BinaryOperatorNode) and value.name in update_instructions:
+        if isinstance(value.left, VariableNode) and value.left.name == node.name:
+            other = value.right
+        elif value.name == TokenKind.addition and isinstance(value.right, VariableNode) and \
+                value.right.name == node.name:
+            other = value.left
+    if other is None:
+        yield generate_store(value, variable, out, context)
+        return
+
+    operand = direct_operand(other, context)
+    if operand is None or operand[0] != '$' and operand[0] != '%' and variable[0] != '%':
+        yield process_expression(other, out, context)
+        operand = '%rax'
+    op = update_instructions[value.name]
+    # an immediate and a memory operand leave the size to the suffix
+    out.emit_insn(op + 'q' if operand[0] == '$' and variable[0] != '%' else op, operand, variable)
+
+
+def generate_store(value, location, out, context):
+    # location = value, a constant or variable is moved there directly
+    # where one of the two is a register or an immediate
+    operand = direct_operand(value, context)
+    if operand == '$0' and location in dword_registers:
+        zero_register(location, out)
+    elif operand is not None and (operand[0] == '$' or operand[0] == '%' or location[0] == '%'):
+        out.emit_insn('movq', operand, location)
+    elif location[0] == '%' and isinstance(value, BinaryOperatorNode) and lea_address(value, context) is not None:
+        out.emit_insn('lea', lea_address(value, context), location)
+    else:
+        yield process_expression(value, out, context)
+        out.emit_insn('movq', '%rax', location)
+
 
-    return result, context
+def zero_register(register, out):
+    # the 32 bit xor clears the whole register and is the shortest way to
+    # do it, it clobbers the flags
+    dword = dword_registers[register]
+    out.emit_insn('xor', dword, dword)
 
 
-def process_expression(node, result, context):
+def process_expression(node, out, context):
     if isinstance(node, ConstantNode):
-        result += f"    movq ${node.value}, %rax\n"
+        if context.session.options['optimize'] >= 1 and constant_value(node) == 0:
+            zero_register('%rax', out)
+        else:
+            out.emit_insn('movq', f"${node.value}", '%rax')
     elif isinstance(node, FunctionCallNode):
-        args = node.args
-
-        result += f"    push %rdi\n"
-        result += f"    push %rsi\n"
-        result += f"    push %rdx\n"
-
-        result += f"\n# Align start part start\n\n"
-        result += f"    mov %rsp, %rax\n"
-        n = (8*(len(args)))
-        result += f"    sub ${n}, %rax\n"
-        result += f"    xor %rdx, %rdx\n"
-        result += f"    mov $16, %rcx\n"
-        result += f"    idiv %rcx\n"
-        result += f"    sub %rdx, %rsp\n"
-        result += f"    push %rdx\n"
-        result += f"\n# Align start part end\n\n"
-
-        if len(args) > 0:
-            result += f"\n# Put first argument\n\n"
-            result = process_expression(args[0], result,  context)
-            result += "    movq %rax, %rdi\n"
-        if len(args) > 1:
-            result += f"\n# Put second argument\n\n"
-            result = process_expression(args[1], result,  context)
-            result += "    movq %rax, %rsi\n"
-        if len(args) > 2:
-            result += f"\n# Put third argument\n\n"
-            result = process_expression(args[2], result,  context)
-            result += "    movq %rax, %rdx\n"
-
-        result += f"    callq _{node.name}\n"
-
-        result += f"\n# Align end part start\n\n"
-        result += f"    pop %rdx\n"
-        result += f"    add %rdx, %rsp\n"
-        result += f"\n# Align end part end\n\n"
-
-        result += f"    pop %rdx\n"
-        result += f"    pop %rsi\n"
-        result += f"    pop %rdi\n"
-
+        yield generate_call(node, out, context)
     elif isinstance(node, BreakNode):
-        result += f"    jmp {context.labels.end_label}\n"
+        out.emit_insn('jmp', context.labels.end_label)
     elif isinstance(node, ContinueNode):
-        result += f"    jmp {context.labels.post_expression_label}\n"
+        out.emit_insn('jmp', context.labels.post_expression_label)
     elif isinstance(node, VariableNode):
-        variable = context.variables_data[node.name]
-        result += f"    movq {variable}, %rax\n"
+        variable = context.variables.lookup(node.name)
+        out.emit_insn('movq', variable, '%rax')
     elif isinstance(node, ReturnNode):
-        if node.name == tokenType['return_']:
-            result = process_expression(
-                node.left, result, context)
-            result += f"    jmp end_label_{context.function_name}\n"
+        if node.name == TokenKind.return_:
+            yield process_expression(node.left, out, context)
+            out.emit_insn('jmp', f"end_label_{context.function_name}")
     elif isinstance(node, AssignNode):
-        result += "\n#Assignment start\n\n"
-        result = process_expression(node.left, result, context)
-        variable = context.variables_data[node.name]
-        result += f"    movq %rax, {variable}\n"
+        out.emit_comment("Assignment start")
+        yield process_expression(node.left, out, context)
+        live_range = getattr(node, 'live_range', None)
+        if live_range is None or live_range.read:
+            variable = context.variables.lookup(node.name)
+            out.emit_insn('movq', '%rax', variable)
+        else:
+            context.session.statistics['stores_removed'] += 1
 
-        result += "\n#Assignment end\n\n"
+        out.emit_comment("Assignment end")
 
     elif isinstance(node, ConditionalNode):
-        result += "\n#Conditional (a ? b : c) condition  start\n\n"
-
-        result = process_expression(
-            node.condition, result, context)
-        result += f"    cmp $0, %rax\n"
-        false_branch_label = create_false_branch_label()
-        post_conditional__label = create_post_conditional_number()
-
-        result += f"    je {false_branch_label}\n"
-        result += "\n#Conditional (a ? b : c) true branch  start\n\n"
-
-        result = process_expression(
-            node.true_branch, result, context)
-        result += f"    jmp {post_conditional__label}\n"
-        result += "\n#Conditional (a ? b : c) false branch  start\n\n"
-
-        result += f"{false_branch_label}:\n"
-        result = process_expression(
-            node.false_branch, result, context)
-        result += f"{post_conditional__label}:\n"
+        out.emit_comment("Conditional (a ? b : c) condition  start")
+
+        false_branch_label = context.session.new_label('false_branch')
+        post_conditional__label = context.session.new_label('post_conditional')
+        yield generate_branch(node.condition, false_branch_label, False, out, context)
+
+        out.emit_comment("Conditional (a ? b : c) true branch  start")
+
+        yield process_expression(node.true_branch, out, context)
+        out.emit_insn('jmp', post_conditional__label)
+        out.emit_comment("Conditional (a ? b : c) false branch  start")
+
+        out.emit_label(false_branch_label)
+        yield process_expression(node.false_branch, out, context)
+        out.emit_label(post_conditional__label)
     elif isinstance(node, UnaryOperatorNode):
-        if node.name == tokenType['negation']:
-            result = process_expression(
-                node.left, result, context)
-            result += f"    neg %rax\n"
-        elif node.name == tokenType['bitwise_complement']:
-            result = process_expression(
-                node.left, result, context)
-            result += f"    not %rax\n"
-        elif node.name == tokenType['logical_negation']:
-            result = process_expression(
-                node.left, result, context)
-            result += f"    cmp $0, %rax\n"
-            result += f"    movq $0, %rax\n"
-            result += f"    sete %al\n"
+        if node.name == TokenKind.negation:
+            yield process_expression(node.left, out, context)
+            out.emit_insn('neg', '%rax')
+        elif node.name == TokenKind.bitwise_complement:
+            yield process_expression(node.left, out, context)
+            out.emit_insn('not', '%rax')
+        elif node.name == TokenKind.logical_negation:
+            yield process_expression(node.left, out, context)
+            out.emit_insn('cmp', '$0', '%rax')
+            out.emit_insn('movq', '$0', '%rax')
+            out.emit_insn('sete', '%al')
     elif isinstance(node, NullNode):
-        return result
+        return
     elif isinstance(node, BinaryOperatorNode):
 
-        if node.name == tokenType['logical_or']:
-            clauseLabel = create_clause_label()
-            end_label = create_end_label()
-
-            result = process_expression(
-                node.left, result, context)
-            result += f"    cmp $0, %rax\n"
-            result += f"    je {clauseLabel}\n"
-            result += f"    movq $1, %rax\n"
-            result += f"    jmp {end_label}\n"
-            result += f"{clauseLabel}:\n"
-            result = process_expression(
-                node.right, result, context)
-            result += f"    cmp $0, %rax\n"
-            result += f"    movq $0, %rax\n"
-            result += f"    setne %al\n"
-            result += f"{end_label}:\n"
-
-        elif node.name == tokenType['logical_and']:
-            clauseLabel = create_clause_label()
-            end_label = create_end_label()
-
-            result = process_expression(
-                node.left, result, context)
-            result += f"    cmp $0, %rax\n"
-            result += f"    jne {clauseLabel}\n"
-            result += f"    jmp {end_label}\n"
-            result += f"{clauseLabel}:\n"
-            result = process_expression(
-                node.right, result, context)
-            result += f"    cmp $0, %rax\n"
-            result += f"    movq $0, %rax\n"
-            result += f"    setne %al\n"
-            result += f"{end_label}:\n"
+        if (node.name == TokenKind.logical_or or node.name == TokenKind.logical_and) and \
+                context.session.options['optimize'] >= 1:
+            yield generate_logical_value(node, out, context)
+
+        elif node.name == TokenKind.logical_or:
+            clauseLabel = context.session.new_label('clause')
+            end_label = context.session.new_label('end')
+
+            yield process_expression(node.left, out, context)
+            out.emit_insn('cmp', '$0', '%rax')
+            out.emit_insn('je', clauseLabel)
+            out.emit_insn('movq', '$1', '%rax')
+            out.emit_insn('jmp', end_label)
+            out.emit_label(clauseLabel)
+            yield process_expression(node.right, out, context)
+            out.emit_insn('cmp', '$0', '%rax')
+            out.emit_insn('movq', '$0', '%rax')
+            out.emit_insn('setne', '%al')
+            out.emit_label(end_label)
+
+        elif node.name == TokenKind.logical_and:
+            clauseLabel = context.session.new_label('clause')
+            end_label = context.session.new_label('end')
+
+            yield process_expression(node.left, out, context)
+            out.emit_insn('cmp', '$0', '%rax')
+            out.emit_insn('jne', clauseLabel)
+            out.emit_insn('jmp', end_label)
+            out.emit_label(clauseLabel)
+            yield process_expression(node.right, out, context)
+            out.emit_insn('cmp', '$0', '%rax')
+            out.emit_insn('movq', '$0', '%rax')
+            out.emit_insn('setne', '%al')
+            out.emit_label(end_label)
+
+        elif context.session.options['optimize'] < 1:
+            yield process_expression(node.right, out, context)
+            out.emit_insn('push', '%rax')
+            context.pushed += 8
+            yield process_expression(node.left, out, context)
+            out.emit_insn('pop', reload_register)
+            context.pushed -= 8
+            emit_binary_operation(node.name, reload_register, out, context)
 
         else:
-            result = process_expression(
-                node.right, result, context)
-            result += f"    push %rax\n"
-            result = process_expression(
-                node.left, result, context)
-            result += f"    pop %rbx\n"
-
-            if node.name == tokenType['negation']:
-                result += f"    sub %rbx, %rax\n"
-
-            elif node.name == tokenType['addition']:
-                result += f"    add %rbx, %rax\n"
-
-            elif node.name == tokenType['multiplication']:
-                result += f"    imul %rbx, %rax\n"
-
-            elif node.name == tokenType['division']:
-                result += f"    cqo\n"
-                result += f"    idiv %rbx\n"
-
-            elif node.name == tokenType['equal']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    sete %al\n"
-
-            elif node.name == tokenType['not_equal']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    setne %al\n"
-
-            elif node.name == tokenType['greater_then']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    setg %al\n"
-
-            elif node.name == tokenType['greater_than_or_equal']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    setge %al\n"
-
-            elif node.name == tokenType['less_than']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    setl %al\n"
-
-            elif node.name == tokenType['less_than_equal']:
-                result += f"    cmp %rbx, %rax\n"
-                result += f"    movq $0, %rax\n"
-                result += f"    setle %al\n"
-
-            elif node.name == tokenType['mod']:
-                result += f"    cqo\n"
-                result += f"    idiv %rbx\n"
-                result += f"    mov %rdx, %rax\n"
-
+            yield generate_binary_operation(node, out, context)
+    else:
+        raise ValueError('wrong node')
+
+
+def generate_call(node, out, context):
+    # System V call: six arguments in registers, the rest pushed right to
+    # left, and %rsp 16 byte aligned at the call. The depth of the frame is
+    # known, so the alignment is a padding fixed at compile time. Only the
+    # caller saved registers that hold something are saved: intermediate
+    # results, the parameters at -O0 and the arguments of an enclosing call
+    # being set up.
+    args = node.args
+    stack_arguments = args[len(argument_registers):]
+    free_registers = context.free_registers
+    argument_registers_in_use = context.argument_registers
+    saved_registers = [register for register in scratch_registers if register not in free_registers]
+    saved_registers += argument_registers_in_use
+    for register in saved_registers:
+        out.emit_insn('push', register)
+    context.pushed += 8 * len(saved_registers)
+    padding = (stack_depth(context) + 8 * len(stack_arguments)) % 16
+    if padding:
+        out.emit_insn('sub', f"${padding}", '%rsp')
+        context.pushed += padding
+
+    if context.session.options['optimize'] < 1:
+        # every argument is pushed, the first six are then popped into their
+        # registers, which the parameters living there are saved from
+        for argument in reversed(args):
+            yield process_expression(argument, out, context)
+            out.emit_insn('push', '%rax')
+            context.pushed += 8
+        for register in argument_registers[:len(args)]:
+            out.emit_insn('pop', register)
+            context.pushed -= 8
+    else:
+        # the callee may clobber every scratch register, the arguments get
+        # the full pool. One that needs evaluating goes straight into its
+        # register, which is then taken out of the pool, constants and
+        # variables are loaded last.
+        context.free_registers = list(scratch_registers)
+        context.argument_registers = ()
+        for argument in reversed(stack_arguments):
+            operand = direct_operand(argument, context)
+            if operand is None:
+                yield process_expression(argument, out, context)
+                operand = '%rax'
+            out.emit_insn('push' if operand[0] == '%' else 'pushq', operand)
+            context.pushed += 8
+        direct_arguments = []
+        for argument, register in zip(args, argument_registers):
+            operand = direct_operand(argument, context)
+            if operand is not None:
+                direct_arguments.append((operand, register))
+                continue
+            yield generate_store(argument, register, out, context)
+            if register in context.free_registers:
+                context.free_registers.remove(register)
+            context.argument_registers += (register,)
+        for operand, register in direct_arguments:
+            if operand == '$0':
+                zero_register(register, out)
+            else:
+                out.emit_insn('movq', operand, register)
+
+    out.emit_insn('callq', f"_{node.name}")
+    bytes_to_release = 8 * len(stack_arguments) + padding
+    if bytes_to_release:
+        out.emit_insn('add', f"${bytes_to_release}", '%rsp')
+    context.pushed -= bytes_to_release
+
+    context.argument_registers = argument_registers_in_use
+    context.free_registers = free_registers
+    for register in reversed(saved_registers):
+        out.emit_insn('pop', register)
+    context.pushed -= 8 * len(saved_registers)
+
+
+def generate_binary_operation(node, out, context):
+    # register based evaluation of an arithmetic or comparison operator
+    address = lea_address(node, context)
+    if address is not None:
+        out.emit_insn('lea', address, '%rax')
+        return
+    operand, reversed_operands, register = yield generate_operands(node, out, context)
+    if reversed_operands:
+        emit_reversed_binary_operation(node.name, operand, out, context)
+    else:
+        emit_binary_operation(node.name, operand, out, context)
+    if register is not None:
+        context.free_registers.append(register)
+
+
+def lea_address(node, context):
+    # a sum of variables kept in registers, one of them possibly scaled by
+    # 2, 4 or 8, and constants as the address operand of one lea, None for
+    # anything else
+    if node.name != TokenKind.addition and node.name != TokenKind.negation:
+        return None
+    registers = []
+    displacement = 0
+    stack = [(node, 1)]
+    while stack:
+        term, sign = stack.pop()
+        value = constant_value(term)
+        if value is not None:
+            displacement += sign * value
+            continue
+        if isinstance(term, BinaryOperatorNode) and \
+                (term.name == TokenKind.addition or term.name == TokenKind.negation):
+            stack.append((term.left, sign))
+            stack.append((term.right, sign if term.name == TokenKind.addition else -sign))
+            continue
+        scale = 1
+        if isinstance(term, BinaryOperatorNode) and term.name == TokenKind.multiplication:
+            scale = constant_value(term.right)
+            if scale is None:
+                scale = constant_value(term.left)
+                term = term.right
             else:
-                raise 'wrong node'
+                term = term.left
+            if scale not in lea_scales:
+                return None
+        if sign < 0 or len(registers) == 2 or not isinstance(term, VariableNode):
+            return None
+        location = context.variables.lookup(term.name)
+        if location[0] != '%':
+            return None
+        registers.append((scale, location))
+    # only one of them can be scaled
+    registers.sort()
+    if not registers or len(registers) == 2 and registers[0][0] != 1 or \
+            not -immediate_limit <= displacement < immediate_limit:
+        return None
+    displacement = displacement or ''
+    if len(registers) == 1:
+        scale, location = registers[0]
+        return f"{displacement}({location})" if scale == 1 else f"{displacement or 0}(,{location},{scale})"
+    (_, base), (scale, index) = registers
+    return f"{displacement}({base},{index})" if scale == 1 else f"{displacement}({base},{index},{scale})"
+
+
+def generate_operands(node, out, context):
+    # puts one operand of a binary operator in %rax and returns the other
+    # one, whether %rax holds the right operand instead of the left and the
+    # scratch register to free once the operation is emitted. A constant or
+    # variable operand is used in place, otherwise the operand needing more
+    # registers is evaluated first and held in a scratch register while the
+    # other one is evaluated. Only when the scratch registers run out is the
+    # intermediate result pushed on the stack.
+    operator = node.name
+    right_operand = direct_operand(node.right, context)
+    if right_operand is not None:
+        yield process_expression(node.left, out, context)
+        return right_operand, False, None
+
+    left_operand = direct_operand(node.left, context)
+    if left_operand is not None and operator != TokenKind.division and operator != TokenKind.mod:
+        yield process_expression(node.right, out, context)
+        return left_operand, True, None
+
+    left_first = register_need(node.left) > register_need(node.right)
+    yield process_expression(node.left if left_first else node.right, out, context)
+    free_registers = context.free_registers
+    if free_registers:
+        register = free_registers.pop()
+        out.emit_insn('movq', '%rax', register)
     else:
-        raise 'wrong node'
-    return result
+        register = None
+        out.emit_insn('push', '%rax')
+        context.pushed += 8
+
+    yield process_expression(node.right if left_first else node.left, out, context)
+
+    if register is None:
+        out.emit_insn('pop', reload_register)
+        context.pushed -= 8
+        return reload_register, left_first, None
+    return register, left_first, register
+
+
+def generate_comparison(node, out, context):
+    # compares the operands of a comparison, returns the condition code under
+    # which it holds. A variable is compared where it lives, with the other
+    # operand when that is a constant or variable.
+    left_operand = direct_operand(node.left, context)
+    right_operand = direct_operand(node.right, context)
+    if left_operand is not None and right_operand is not None:
+        if emit_compare(left_operand, right_operand, out):
+            return comparison_sets[node.name][3:]
+        if emit_compare(right_operand, left_operand, out):
+            return swapped_comparison_sets[node.name][3:]
+
+    operand, reversed_operands, register = yield generate_operands(node, out, context)
+    out.emit_insn('cmp', operand, '%rax')
+    if register is not None:
+        context.free_registers.append(register)
+    sets = swapped_comparison_sets if reversed_operands else comparison_sets
+    return sets[node.name][3:]
+
+
+def emit_compare(location, operand, out):
+    # cmp operand, location when the instruction can take the two as they
+    # are, False when it cannot
+    if location[0] == '$' or operand[0] != '$' and operand[0] != '%' and location[0] != '%':
+        return False
+    if operand == '$0' and location[0] == '%':
+        out.emit_insn('test', location, location)
+    else:
+        out.emit_insn('cmpq' if operand[0] == '$' and location[0] != '%' else 'cmp', operand, location)
+    return True
+
+
+def generate_branch(node, label, jump_when, out, context):
+    # jumps to label when node is true, or false with jump_when False, and
+    # falls through otherwise. At -O1 a comparison jumps on the flags of its
+    # cmp and &&, || and ! become chains of jumps, so a condition is only
+    # materialised as 0 or 1 when it is neither.
+    if context.session.options['optimize'] >= 1:
+        if isinstance(node, BinaryOperatorNode) and node.name in comparison_sets:
+            condition = yield generate_comparison(node, out, context)
+            out.emit_insn(f"j{condition if jump_when else inverse_conditions[condition]}", label)
+            return
+        if isinstance(node, BinaryOperatorNode) and \
+                (node.name == TokenKind.logical_and or node.name == TokenKind.logical_or):
+            if (node.name == TokenKind.logical_or) == jump_when:
+                # either operand alone decides the jump
+                yield generate_branch(node.left, label, jump_when, out, context)
+                yield generate_branch(node.right, label, jump_when, out, context)
+            else:
+                # the left operand alone can only decide to fall through
+                skip_label = context.session.new_label('clause')
+                yield generate_branch(node.left, skip_label, not jump_when, out, context)
+                yield generate_branch(node.right, label, jump_when, out, context)
+                out.emit_label(skip_label)
+            return
+        if isinstance(node, UnaryOperatorNode) and node.name == TokenKind.logical_negation:
+            yield generate_branch(node.left, label, not jump_when, out, context)
+            return
+        if isinstance(node, VariableNode):
+            emit_compare(context.variables.lookup(node.name), '$0', out)
+            out.emit_insn('jne' if jump_when else 'je', label)
+            return
+
+    yield process_expression(node, out, context)
+    out.emit_insn('cmp', '$0', '%rax')
+    out.emit_insn('jne' if jump_when else 'je', label)
+
+
+def generate_logical_value(node, out, context):
+    # a && b or a || b as 0 or 1 in %rax: the left operand only decides
+    # whether the right one is evaluated at all
+    short_circuit_label = context.session.new_label('clause')
+    end_label = context.session.new_label('end')
+    is_or = node.name == TokenKind.logical_or
+    yield generate_branch(node.left, short_circuit_label, is_or, out, context)
+    yield process_expression(node.right, out, context)
+    if not is_boolean(node.right):
+        out.emit_insn('cmp', '$0', '%rax')
+        out.emit_insn('movq', '$0', '%rax')
+        out.emit_insn('setne', '%al')
+    out.emit_insn('jmp', end_label)
+    out.emit_label(short_circuit_label)
+    out.emit_insn('movq', '$1' if is_or else '$0', '%rax')
+    out.emit_label(end_label)
+
+
+# immediates are sign extended 32 bit values
+immediate_limit = 1 << 31
+
+# the low half of each 64 bit register, writing it clears the upper half
+dword_registers = {'%rax': '%eax', '%rbx': '%ebx', '%rcx': '%ecx', '%rdx': '%edx', '%rsi': '%esi', '%rdi': '%edi',
+                   **{f'%r{number}': f'%r{number}d' for number in range(8, 16)}}
+
+# the index scales of an address
+lea_scales = (1, 2, 4, 8)
+
+# the assignments x = x <operator> e that update x in place
+update_instructions = {TokenKind.addition: 'add', TokenKind.negation: 'sub'}
+unary_update_instructions = {TokenKind.negation: 'neg', TokenKind.bitwise_complement: 'not'}
+
+comparison_sets = {
+    TokenKind.equal: 'sete',
+    TokenKind.not_equal: 'setne',
+    TokenKind.greater_then: 'setg',
+    TokenKind.greater_than_or_equal: 'setge',
+    TokenKind.less_than: 'setl',
+    TokenKind.less_than_equal: 'setle',
+}
+
+# the set instruction giving the same result with the operands swapped
+swapped_comparison_sets = {
+    TokenKind.equal: 'sete',
+    TokenKind.not_equal: 'setne',
+    TokenKind.greater_then: 'setl',
+    TokenKind.greater_than_or_equal: 'setle',
+    TokenKind.less_than: 'setg',
+    TokenKind.less_than_equal: 'setge',
+}
+
+commutative_operators = {TokenKind.addition, TokenKind.multiplication, TokenKind.equal, TokenKind.not_equal}
+
+# the operators generate_binary_operation handles, && and || branch instead
+register_operators = {TokenKind.addition, TokenKind.negation, TokenKind.multiplication, TokenKind.division,
+                      TokenKind.mod, *comparison_sets}
+
+
+def direct_operand(node, context):
+    # the operand a constant or variable can be used as without loading it
+    # into a register first, None for anything else
+    if isinstance(node, VariableNode):
+        return context.variables.lookup(node.name)
+    if isinstance(node, ConstantNode):
+        value = constant_value(node)
+        if value is not None and -immediate_limit <= value < immediate_limit:
+            return f"${value}"
+    return None
+
+
+def register_need(node):
+    # Sethi-Ullman number of an expression: how many registers, %rax
+    # included, it takes to evaluate without spilling. Computed bottom up
+    # with an explicit stack and remembered on the node.
+    stack = [node]
+    while stack:
+        current = stack[-1]
+        if hasattr(current, 'need'):
+            stack.pop()
+            continue
+        if isinstance(current, BinaryOperatorNode) and current.name in register_operators:
+            pending = [child for child in (current.left, current.right)
+                       if not isinstance(child, leaf_nodes) and not hasattr(child, 'need')]
+            if pending:
+                stack.extend(pending)
+                continue
+            right_need = 0 if isinstance(current.right, leaf_nodes) else current.right.need
+            left_need = 1 if isinstance(current.left, leaf_nodes) else current.left.need
+            current.need = max(left_need, right_need) if left_need != right_need else left_need + 1
+        elif isinstance(current, UnaryOperatorNode) and not isinstance(current.left, leaf_nodes):
+            if not hasattr(current.left, 'need'):
+                stack.append(current.left)
+                continue
+            current.need = current.left.need
+        else:
+            # calls save what is live, everything else works in %rax
+            current.need = 1
+        stack.pop()
+    return node.need
+
+
+# multipliers a single lea computes, with the scale it uses
+lea_multipliers = {3: 2, 5: 4, 9: 8}
+
+
+def emit_constant_multiplication(value, out):
+    # %rax *= value with lea, shl and neg where that takes at most two
+    # instructions, False to leave it to imul
+    magnitude = abs(value)
+    if magnitude == 0:
+        return False
+    shift = (magnitude & -magnitude).bit_length() - 1
+    factor = magnitude >> shift
+    if factor != 1 and factor not in lea_multipliers:
+        return False
+    if (factor != 1) + (shift != 0) + (value < 0) > 2:
+        return False
+    if factor != 1:
+        out.emit_insn('lea', f"(%rax,%rax,{lea_multipliers[factor]})", '%rax')
+    if shift:
+        out.emit_insn('shl', f"${shift}", '%rax')
+    if value < 0:
+        out.emit_insn('neg', '%rax')
+    return True
+
+
+def signed_magic(divisor):
+    # multiplier and shift that turn signed 64 bit division by divisor into
+    # a multiply high, for |divisor| > 1 and not a power of two. The
+    # smallest shift for which the rounding error stays below one, as in
+    # Hacker's Delight, chapter 10.
+    half = 1 << 63
+    magnitude = abs(divisor)
+    limit = half + (divisor < 0)
+    limit = limit - 1 - limit % magnitude
+    shift = 63
+    quotient_limit, remainder_limit = divmod(half, limit)
+    quotient, remainder = divmod(half, magnitude)
+    while True:
+        shift += 1
+        quotient_limit, remainder_limit = 2 * quotient_limit, 2 * remainder_limit
+        if remainder_limit >= limit:
+            quotient_limit, remainder_limit = quotient_limit + 1, remainder_limit - limit
+        quotient, remainder = 2 * quotient, 2 * remainder
+        if remainder >= magnitude:
+            quotient, remainder = quotient + 1, remainder - magnitude
+        delta = magnitude - remainder
+        if quotient_limit > delta or quotient_limit == delta and remainder_limit:
+            break
+    multiplier = quotient + 1 if divisor > 0 else -(quotient + 1)
+    # as the signed 64 bit immediate imul sees
+    multiplier = (multiplier + half) % (1 << 64) - half
+    return multiplier, shift - 64
+
+
+def emit_constant_division(divisor, remainder, scratch, out, save_rdx):
+    # %rax = %rax / divisor, or %rax % divisor with remainder set, truncated
+    # toward zero like idiv without its cost. Powers of two shift a dividend
+    # biased by divisor - 1 when negative, other divisors multiply by the
+    # magic number and correct the rounding of negative quotients. False to
+    # leave it to idiv, division by zero included.
+    magnitude = abs(divisor)
+    if magnitude == 0 or not -immediate_limit <= divisor < immediate_limit:
+        return False
+    if magnitude == 1:
+        if remainder:
+            out.emit_insn('movq', '$0', '%rax')
+        elif divisor < 0:
+            out.emit_insn('neg', '%rax')
+        return True
+
+    if magnitude & (magnitude - 1) == 0:
+        shift = magnitude.bit_length() - 1
+        out.emit_insn('movq', '%rax', scratch)
+        if shift > 1:
+            out.emit_insn('sar', '$63', scratch)
+        out.emit_insn('shr', f"${64 - shift}", scratch)
+        out.emit_insn('add', scratch, '%rax')
+        if remainder:
+            out.emit_insn('and', f"${magnitude - 1}", '%rax')
+            out.emit_insn('sub', scratch, '%rax')
+        else:
+            out.emit_insn('sar', f"${shift}", '%rax')
+            if divisor < 0:
+                out.emit_insn('neg', '%rax')
+        return True
+
+    multiplier, shift = signed_magic(divisor)
+    if save_rdx:
+        out.emit_insn('push', '%rdx')
+    out.emit_insn('movq', '%rax', scratch)
+    out.emit_insn('movq', f"${multiplier}", '%rdx')
+    out.emit_insn('imul', '%rdx')
+    if divisor > 0 and multiplier < 0:
+        out.emit_insn('add', scratch, '%rdx')
+    elif divisor < 0 and multiplier > 0:
+        out.emit_insn('sub', scratch, '%rdx')
+    if shift:
+        out.emit_insn('sar', f"${shift}", '%rdx')
+    out.emit_insn('movq', '%rdx', '%rax')
+    out.emit_insn('shr', '$63', '%rdx')
+    out.emit_insn('add', '%rdx', '%rax')
+    if remainder:
+        out.emit_insn('imul', f"${divisor}", '%rax')
+        out.emit_insn('neg', '%rax')
+        out.emit_insn('add', scratch, '%rax')
+    if save_rdx:
+        out.emit_insn('pop', '%rdx')
+    return True
+
+
+def emit_division(operator, operand, out, context):
+    # idiv takes the dividend in %rdx:%rax and leaves the remainder in %rdx,
+    # so a divisor in %rdx or an immediate goes through the reload register
+    # and a third parameter living in %rdx is saved around it
+    save_rdx = '%rdx' in context.argument_registers
+    if operand[0] == '$' and emit_constant_division(int(operand[1:]), operator == TokenKind.mod, reload_register,
+                                                    out, save_rdx):
+        return
+    if operand[0] == '$' or operand == '%rdx':
+        out.emit_insn('movq', operand, reload_register)
+        operand = reload_register
+    if save_rdx:
+        out.emit_insn('push', '%rdx')
+    out.emit_insn('cqo')
+    # without a register operand the size has to be spelled out
+    out.emit_insn('idiv' if operand[0] == '%' else 'idivq', operand)
+    if operator == TokenKind.mod:
+        out.emit_insn('mov', '%rdx', '%rax')
+    if save_rdx:
+        out.emit_insn('pop', '%rdx')
+
+
+def emit_binary_operation(operator, operand, out, context):
+    # %rax = %rax <operator> operand
+    if operator == TokenKind.negation:
+        out.emit_insn('sub', operand, '%rax')
+
+    elif operator == TokenKind.addition:
+        out.emit_insn('add', operand, '%rax')
+
+    elif operator == TokenKind.multiplication:
+        if operand[0] != '$' or not emit_constant_multiplication(int(operand[1:]), out):
+            out.emit_insn('imul', operand, '%rax')
+
+    elif operator == TokenKind.division or operator == TokenKind.mod:
+        emit_division(operator, operand, out, context)
+
+    elif operator in comparison_sets:
+        out.emit_insn('cmp', operand, '%rax')
+        out.emit_insn('movq', '$0', '%rax')
+        out.emit_insn(comparison_sets[operator], '%al')
 
+    else:
+        raise ValueError('wrong node')
 
-if __name__=="__main__":
+
+def emit_reversed_binary_operation(operator, operand, out, context):
+    # %rax = operand <operator> %rax
+    if operator in commutative_operators:
+        emit_binary_operation(operator, operand, out, context)
+
+    elif operator == TokenKind.negation:
+        out.emit_insn('neg', '%rax')
+        out.emit_insn('add', operand, '%rax')
+
+    elif operator in comparison_sets:
+        out.emit_insn('cmp', operand, '%rax')
+        out.emit_insn('movq', '$0', '%rax')
+        out.emit_insn(swapped_comparison_sets[operator], '%al')
+
+    else:
+        out.emit_insn('xchg', '%rax', operand)
+        emit_binary_operation(operator, operand, out, context)
+
+
+# Three address intermediate representation, the input of the ir backend.
+# A function lowers to a list of basic blocks: straight line instructions
+# `destination = op operands` followed by one terminator, a jump, a branch on
+# a value being non zero or a return. Every transfer of control, loops,
+# break, continue and the short circuit of && and || included, is an edge of
+# the control flow graph. Operands are ints for constants, '%n' for
+# temporaries, '@name' for globals and the source name for locals and
+# parameters, with a '.n' suffix where a declaration shadows another one.
+
+ir_binary_operators = {
+    TokenKind.addition: 'add',
+    TokenKind.negation: 'sub',
+    TokenKind.multiplication: 'mul',
+    TokenKind.division: 'div',
+    TokenKind.mod: 'mod',
+    TokenKind.equal: 'eq',
+    TokenKind.not_equal: 'ne',
+    TokenKind.less_than: 'lt',
+    TokenKind.less_than_equal: 'le',
+    TokenKind.greater_then: 'gt',
+    TokenKind.greater_than_or_equal: 'ge',
+}
+
+ir_unary_operators = {
+    TokenKind.negation: 'neg',
+    TokenKind.bitwise_complement: 'not',
+    TokenKind.logical_negation: 'lnot',
+}
+
+# condition code of every comparison, for setcc and jcc
+ir_conditions = {'eq': 'e', 'ne': 'ne', 'lt': 'l', 'le': 'le', 'gt': 'g', 'ge': 'ge'}
+
+
+class IrInstruction:
+    def __init__(self, op, destination, operands, callee=None):
+        self.op = op
+        self.destination = destination
+        self.operands = operands
+        self.callee = callee
+
+
+class BasicBlock:
+    def __init__(self, label):
+        self.label = label
+        self.instructions = []
+        # 'jump', 'branch' or 'return'. A branch tests operand and goes to the
+        # first successor when it is non zero, a return hands operand back
+        self.terminator = None
+        self.operand = None
+        self.successors = []
+        self.predecessors = []
+
+
+class IrFunction:
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+        self.blocks = []
+
+
+class IrBuilder:
+    # the state of lowering one function: the block being filled, the local
+    # names in scope and where break and continue go
+    def __init__(self, function, context):
+        self.function = function
+        self.context = context
+        self.block = None
+        self.temporaries = 0
+        self.locals = SymbolTable()
+        self.declarations = {}
+        self.break_target = None
+        self.continue_target = None
+
+    def new_block(self, kind):
+        return BasicBlock(self.context.session.new_label(kind))
+
+    def start_block(self, block):
+        # a block left without a terminator falls through into the next one
+        if self.block is not None and self.block.terminator is None:
+            self.jump(block)
+        self.function.blocks.append(block)
+        self.block = block
+
+    def new_temporary(self):
+        temporary = f"%{self.temporaries}"
+        self.temporaries += 1
+        return temporary
+
+    def emit(self, op, destination, operands, callee=None):
+        self.block.instructions.append(IrInstruction(op, destination, operands, callee))
+        return destination
+
+    def terminate(self, terminator, operand, successors):
+        self.block.terminator = terminator
+        self.block.operand = operand
+        self.block.successors = successors
+
+    def jump(self, target):
+        self.terminate('jump', None, [target])
+
+    def branch(self, condition, true_target, false_target):
+        self.terminate('branch', condition, [true_target, false_target])
+
+    def assign(self, local, value):
+        # the value of a statement level assignment that was computed just
+        # now goes straight into the local instead of through its temporary
+        instructions = self.block.instructions
+        if is_temporary(value) and instructions and instructions[-1].destination == value:
+            instructions[-1].destination = local
+        else:
+            self.emit('copy', local, [value])
+
+    def declare(self, name):
+        count = self.declarations.get(name, 0)
+        self.declarations[name] = count + 1
+        local = name if count == 0 else f"{name}.{count}"
+        self.locals.declare(name, local)
+        return local
+
+    def lookup(self, name):
+        local = self.locals.symbols.get(name)
+        if local is not None:
+            return local
+        # raises for an undeclared name like the ast backend does
+        self.context.variables.lookup(name)
+        return f"@{name}"
+
+
+def is_temporary(operand):
+    return isinstance(operand, str) and operand[0] == '%'
+
+
+def is_global(operand):
+    return isinstance(operand, str) and operand[0] == '@'
+
+
+def lower_function(node, context):
+    function = IrFunction(node.name, [])
+    builder = IrBuilder(function, context)
+    builder.start_block(builder.new_block('entry'))
+    for name in node.variables:
+        function.parameters.append(builder.declare(name))
+
+    for statement in node.statements:
+        yield lower_statement(statement, builder)
+    # falling off the end returns 0, which is what main has to do
+    if builder.block.terminator is None:
+        builder.terminate('return', 0, [])
+
+    build_cfg(function)
+    return function
+
+
+def build_cfg(function):
+    for block in function.blocks:
+        block.predecessors = []
+    for block in function.blocks:
+        for successor in block.successors:
+            successor.predecessors.append(block)
+
+
+def ir_use_counts(function):
+    # how many times each operand is read
+    uses = {}
+    for block in function.blocks:
+        for instruction in block.instructions:
+            for operand in instruction.operands:
+                uses[operand] = uses.get(operand, 0) + 1
+        uses[block.operand] = uses.get(block.operand, 0) + 1
+    return uses
+
+
+def eliminate_dead_code(function):
+    # drops the blocks no path from the entry reaches, then the instructions
+    # whose result is never read until nothing changes, a call only loses its
+    # destination. Returns the number of instructions and stores dropped.
+    reached = {function.blocks[0]}
+    pending = [function.blocks[0]]
+    while pending:
+        for successor in pending.pop().successors:
+            if successor not in reached:
+                reached.add(successor)
+                pending.append(successor)
+    dropped = sum(len(block.instructions) for block in function.blocks if block not in reached)
+    function.blocks = [block for block in function.blocks if block in reached]
+    build_cfg(function)
+
+    changed = True
+    while changed:
+        changed = False
+        uses = ir_use_counts(function)
+        for block in function.blocks:
+            live = []
+            for instruction in block.instructions:
+                destination = instruction.destination
+                if destination is None or destination in uses or is_global(destination):
+                    live.append(instruction)
+                elif instruction.op == 'call':
+                    instruction.destination = None
+                    live.append(instruction)
+                    dropped += 1
+            if len(live) != len(block.instructions):
+                dropped += len(block.instructions) - len(live)
+                block.instructions = live
+                changed = True
+    return dropped
+
+
+def lower_statement(node, builder):
+    if isinstance(node, DeclarationNode):
+        local = builder.declare(node.name)
+        if hasattr(node, 'left'):
+            value = yield lower_expression(node.left, builder)
+            builder.assign(local, value)
+
+    elif isinstance(node, AssignNode):
+        value = yield lower_expression(node.left, builder)
+        builder.assign(builder.lookup(node.name), value)
+
+    elif isinstance(node, CompoundNode):
+        builder.locals.push_scope()
+        for statement in node.statements:
+            yield lower_statement(statement, builder)
+        builder.locals.pop_scope()
+
+    elif isinstance(node, IfNode):
+        true_block = builder.new_block('if_true')
+        end_block = builder.new_block('post_conditional')
+        false_block = end_block if node.false_branch is None else builder.new_block('if_false')
+        yield lower_condition(node.condition, true_block, false_block, builder)
+        builder.start_block(true_block)
+        yield lower_statement(node.true_branch, builder)
+        builder.jump(end_block)
+        if node.false_branch is not None:
+            builder.start_block(false_block)
+            yield lower_statement(node.false_branch, builder)
+        builder.start_block(end_block)
+
+    elif isinstance(node, WhileNode):
+        start_block = builder.new_block('while_start')
+        body_block = builder.new_block('while_body')
+        end_block = builder.new_block('while_end')
+        builder.start_block(start_block)
+        yield lower_condition(node.condition, body_block, end_block, builder)
+        builder.start_block(body_block)
+        yield lower_loop_body(node.body, end_block, start_block, builder)
+        builder.jump(start_block)
+        builder.start_block(end_block)
+
+    elif isinstance(node, DoWhileNode):
+        body_block = builder.new_block('while_start')
+        condition_block = builder.new_block('while_condition')
+        end_block = builder.new_block('while_end')
+        builder.start_block(body_block)
+        yield lower_loop_body(node.body, end_block, condition_block, builder)
+        builder.start_block(condition_block)
+        yield lower_condition(node.condition, body_block, end_block, builder)
+        builder.start_block(end_block)
+
+    elif isinstance(node, (ForNode, ForDeclarationNode)):
+        builder.locals.push_scope()
+        start_block = builder.new_block('for_start')
+        body_block = builder.new_block('for_body')
+        post_expression_block = builder.new_block('for_post_expression')
+        end_block = builder.new_block('for_end')
+        if isinstance(node, ForDeclarationNode):
+            yield lower_statement(node.initial_expression, builder)
+        else:
+            yield lower_expression(node.initial_expression, builder)
+        builder.start_block(start_block)
+        yield lower_condition(node.condition, body_block, end_block, builder)
+        builder.start_block(body_block)
+        yield lower_loop_body(node.body, end_block, post_expression_block, builder)
+        builder.start_block(post_expression_block)
+        yield lower_expression(node.post_expression, builder)
+        builder.jump(start_block)
+        builder.start_block(end_block)
+        builder.locals.pop_scope()
+
+    elif isinstance(node, ReturnNode):
+        value = yield lower_expression(node.left, builder)
+        # a bare return; returns 0 like falling off the end
+        builder.terminate('return', 0 if value is None else value, [])
+        builder.start_block(builder.new_block('unreachable'))
+
+    elif isinstance(node, (BreakNode, ContinueNode)):
+        target = builder.break_target if isinstance(node, BreakNode) else builder.continue_target
+        if target is None:
+            raise ValueError('break or continue outside of a loop')
+        builder.jump(target)
+        builder.start_block(builder.new_block('unreachable'))
+
+    else:
+        yield lower_expression(node, builder)
+
+
+def lower_loop_body(body, break_target, continue_target, builder):
+    previous_targets = builder.break_target, builder.continue_target
+    builder.break_target = break_target
+    builder.continue_target = continue_target
+    yield lower_statement(body, builder)
+    builder.break_target, builder.continue_target = previous_targets
+
+
+def lower_condition(node, true_block, false_block, builder):
+    # ends the current block with edges to true_block and false_block, && and
+    # || become a chain of branches instead of a computed 0 or 1
+    if isinstance(node, NullNode):
+        builder.jump(true_block)
+        return
+    value = constant_value(node)
+    if value is not None:
+        builder.jump(true_block if value else false_block)
+        return
+    if isinstance(node, BinaryOperatorNode) and node.name in (TokenKind.logical_and, TokenKind.logical_or):
+        clause_block = builder.new_block('clause')
+        if node.name == TokenKind.logical_and:
+            yield lower_condition(node.left, clause_block, false_block, builder)
+        else:
+            yield lower_condition(node.left, true_block, clause_block, builder)
+        builder.start_block(clause_block)
+        yield lower_condition(node.right, true_block, false_block, builder)
+        return
+    if isinstance(node, UnaryOperatorNode) and node.name == TokenKind.logical_negation:
+        yield lower_condition(node.left, false_block, true_block, builder)
+        return
+    condition = yield lower_expression(node, builder)
+    builder.branch(condition, true_block, false_block)
+
+
+def lower_expression(node, builder):
+    # emits the instructions computing node and returns the operand holding
+    # its value, None for a NullNode
+    if isinstance(node, ConstantNode):
+        value = constant_value(node)
+        if value is None:
+            raise ValueError(f'invalid integer constant {node.value}')
+        return value
+    if isinstance(node, VariableNode):
+        return builder.lookup(node.name)
+    if isinstance(node, NullNode):
+        return None
+    if isinstance(node, AssignNode):
+        value = yield lower_expression(node.left, builder)
+        builder.emit('copy', builder.lookup(node.name), [value])
+        return value
+    if isinstance(node, UnaryOperatorNode):
+        operand = yield lower_expression(node.left, builder)
+        return builder.emit(ir_unary_operators[node.name], builder.new_temporary(), [operand])
+    if isinstance(node, FunctionCallNode):
+        arguments = []
+        for argument in node.args:
+            arguments.append((yield lower_expression(argument, builder)))
+        return builder.emit('call', builder.new_temporary(), arguments, node.name)
+    if isinstance(node, ConditionalNode) or (isinstance(node, BinaryOperatorNode) and
+                                             node.name in (TokenKind.logical_and, TokenKind.logical_or)):
+        result = builder.new_temporary()
+        true_block = builder.new_block('true_branch')
+        false_block = builder.new_block('false_branch')
+        end_block = builder.new_block('post_conditional')
+        condition = node.condition if isinstance(node, ConditionalNode) else node
+        yield lower_condition(condition, true_block, false_block, builder)
+        builder.start_block(true_block)
+        value = 1 if condition is node else (yield lower_expression(node.true_branch, builder))
+        builder.emit('copy', result, [value])
+        builder.jump(end_block)
+        builder.start_block(false_block)
+        value = 0 if condition is node else (yield lower_expression(node.false_branch, builder))
+        builder.emit('copy', result, [value])
+        builder.start_block(end_block)
+        return result
+    if isinstance(node, BinaryOperatorNode):
+        left = yield lower_expression(node.left, builder)
+        right = yield lower_expression(node.right, builder)
+        return builder.emit(ir_binary_operators[node.name], builder.new_temporary(), [left, right])
+    raise ValueError('wrong node')
+
+
+def format_ir_instruction(instruction):
+    operands = ', '.join(map(str, instruction.operands))
+    if instruction.op == 'copy':
+        return f"{instruction.destination} = {operands}"
+    if instruction.op == 'call':
+        call = f"call {instruction.callee}({operands})"
+        return call if instruction.destination is None else f"{instruction.destination} = {call}"
+    return f"{instruction.destination} = {instruction.op} {operands}"
+
+
+def dump_ir(function):
+    # readable listing of a function's blocks, each with its predecessors
+    lines = [f"function {function.name}({', '.join(function.parameters)})"]
+    for block in function.blocks:
+        predecessors = ', '.join(predecessor.label for predecessor in block.predecessors)
+        lines.append(f"{block.label}:" + (f"  # from {predecessors}" if predecessors else ''))
+        for instruction in block.instructions:
+            lines.append(f"    {format_ir_instruction(instruction)}")
+        targets = ', '.join(successor.label for successor in block.successors)
+        if block.terminator == 'jump':
+            lines.append(f"    jump {targets}")
+        elif block.terminator == 'branch':
+            lines.append(f"    branch {block.operand}, {targets}")
+        else:
+            lines.append(f"    return {block.operand}")
+    return '\n'.join(lines) + '\n'
+
+
+# x86-64 backend for the ir. Every local and temporary gets its own stack
+# slot, an instruction loads its first operand into %rax, uses the second
+# one in place and stores the result. Calls follow the System V convention:
+# six arguments in registers, the rest on the stack, and the frame keeps
+# %rsp 16 byte aligned so no call has to realign it at runtime.
+ir_arithmetic_instructions = {'add': 'add', 'sub': 'sub', 'mul': 'imul'}
+
+
+def ir_frame_layout(function):
+    # stack slot of every local and temporary, parameters past the sixth
+    # stay where the caller put them
+    locations = {}
+    for index, name in enumerate(function.parameters[len(argument_registers):]):
+        locations[name] = f"{16 + 8 * index}(%rbp)"
+    names = list(function.parameters[:len(argument_registers)])
+    for block in function.blocks:
+        for instruction in block.instructions:
+            names.append(instruction.destination)
+            names.extend(instruction.operands)
+        names.append(block.operand)
+    slots = 0
+    for name in names:
+        if isinstance(name, str) and name[0] != '@' and name not in locations:
+            slots += 1
+            locations[name] = f"{-8 * slots}(%rbp)"
+    return locations, (slots + 1) // 2 * 16
+
+
+def ir_operand(operand, locations, out, scratch):
+    # operand as an instruction source: a slot, a global or an immediate.
+    # Constants that do not fit a sign extended immediate go through scratch.
+    if isinstance(operand, int):
+        if -immediate_limit <= operand < immediate_limit:
+            return f"${operand}"
+        out.emit_insn('movq', f"${operand}", scratch)
+        return scratch
+    if operand[0] == '@':
+        return f"_{operand[1:]}(%rip)"
+    return locations[operand]
+
+
+def ir_load(operand, register, locations, out):
+    if isinstance(operand, int):
+        out.emit_insn('movq', f"${operand}", register)
+    else:
+        out.emit_insn('movq', ir_operand(operand, locations, out, register), register)
+
+
+def generate_ir_instruction(instruction, out, locations):
+    op = instruction.op
+    operands = instruction.operands
+    if op == 'call':
+        generate_ir_call(instruction, out, locations)
+        if instruction.destination is not None:
+            out.emit_insn('movq', '%rax', ir_operand(instruction.destination, locations, out, None))
+        return
+
+    destination = ir_operand(instruction.destination, locations, out, None)
+    if op == 'copy':
+        source = ir_operand(operands[0], locations, out, '%rax')
+        if source[0] == '$' or source[0] == '%':
+            out.emit_insn('movq', source, destination)
+        else:
+            out.emit_insn('movq', source, '%rax')
+            out.emit_insn('movq', '%rax', destination)
+        return
+
+    ir_load(operands[0], '%rax', locations, out)
+    constant = operands[1] if len(operands) > 1 and isinstance(operands[1], int) else None
+    if op in ir_arithmetic_instructions:
+        if op != 'mul' or constant is None or not emit_constant_multiplication(constant, out):
+            out.emit_insn(ir_arithmetic_instructions[op], ir_operand(operands[1], locations, out, '%rcx'), '%rax')
+    elif op == 'div' or op == 'mod':
+        if constant is None or not emit_constant_division(constant, op == 'mod', '%rcx', out, False):
+            if constant is not None:
+                out.emit_insn('movq', f"${constant}", '%rcx')
+                divisor = '%rcx'
+            else:
+                divisor = ir_operand(operands[1], locations, out, '%rcx')
+            out.emit_insn('cqo')
+            out.emit_insn('idivq', divisor)
+            if op == 'mod':
+                out.emit_insn('movq', '%rdx', '%rax')
+    elif op in ir_conditions:
+        out.emit_insn('cmp', ir_operand(operands[1], locations, out, '%rcx'), '%rax')
+        out.emit_insn('movq', '$0', '%rax')
+        out.emit_insn(f"set{ir_conditions[op]}", '%al')
+    elif op == 'neg' or op == 'not':
+        out.emit_insn(op, '%rax')
+    elif op == 'lnot':
+        out.emit_insn('cmp', '$0', '%rax')
+        out.emit_insn('movq', '$0', '%rax')
+        out.emit_insn('sete', '%al')
+    else:
+        raise ValueError(f'unknown ir instruction {op}')
+    out.emit_insn('movq', '%rax', destination)
+
+
+def generate_ir_call(instruction, out, locations):
+    arguments = instruction.operands
+    stack_arguments = arguments[len(argument_registers):]
+    # the frame is aligned, an odd number of stack arguments needs padding
+    padding = 8 * (len(stack_arguments) % 2)
+    if padding:
+        out.emit_insn('sub', f"${padding}", '%rsp')
+    for argument in reversed(stack_arguments):
+        source = ir_operand(argument, locations, out, '%rax')
+        out.emit_insn('push' if source[0] == '%' else 'pushq', source)
+    for argument, register in zip(arguments, argument_registers):
+        ir_load(argument, register, locations, out)
+    out.emit_insn('callq', f"_{instruction.callee}")
+    if stack_arguments:
+        out.emit_insn('add', f"${8 * len(stack_arguments) + padding}", '%rsp')
+
+
+def fused_comparison(block, uses):
+    # the comparison computing a branch condition right before the branch,
+    # which then compares and jumps without materialising a 0 or 1
+    if block.terminator != 'branch' or not block.instructions:
+        return None
+    last = block.instructions[-1]
+    if last.op in ir_conditions and last.destination == block.operand and is_temporary(last.destination) \
+            and uses.get(last.destination) == 1:
+        return last
+    return None
+
+
+def generate_ir_function(function, out, context):
+    locations, frame_size = ir_frame_layout(function)
+    uses = ir_use_counts(function)
+    end_label = f"end_label_{function.name}"
+
+    out.emit_label(f"_{function.name}")
+    out.emit_insn('push', '%rbp')
+    out.emit_insn('movq', '%rsp', '%rbp')
+    if frame_size:
+        out.emit_insn('sub', f"${frame_size}", '%rsp')
+    for name, register in zip(function.parameters, argument_registers):
+        out.emit_insn('movq', register, locations[name])
+
+    blocks = function.blocks
+    for index, block in enumerate(blocks):
+        next_block = blocks[index + 1] if index + 1 < len(blocks) else None
+        if block.predecessors:
+            out.emit_label(block.label)
+        comparison = fused_comparison(block, uses)
+        instructions = block.instructions if comparison is None else block.instructions[:-1]
+        for instruction in instructions:
+            generate_ir_instruction(instruction, out, locations)
+
+        if block.terminator == 'return':
+            ir_load(block.operand, '%rax', locations, out)
+            if next_block is not None:
+                out.emit_insn('jmp', end_label)
+        elif block.terminator == 'jump':
+            if block.successors[0] is not next_block:
+                out.emit_insn('jmp', block.successors[0].label)
+        else:
+            true_block, false_block = block.successors
+            if comparison is not None:
+                left, right = comparison.operands
+                ir_load(left, '%rax', locations, out)
+                out.emit_insn('cmp', ir_operand(right, locations, out, '%rcx'), '%rax')
+                condition = ir_conditions[comparison.op]
+            elif isinstance(block.operand, int):
+                out.emit_insn('jmp', (true_block if block.operand else false_block).label)
+                continue
+            else:
+                out.emit_insn('cmpq', '$0', ir_operand(block.operand, locations, out, None))
+                condition = 'ne'
+            if true_block is next_block:
+                out.emit_insn(f"j{inverse_conditions[condition]}", false_block.label)
+            else:
+                out.emit_insn(f"j{condition}", true_block.label)
+                if false_block is not next_block:
+                    out.emit_insn('jmp', false_block.label)
+
+    out.emit_label(end_label)
+    out.emit_insn('movq', '%rbp', '%rsp')
+    out.emit_insn('pop', '%rbp')
+    out.emit_insn('ret')
+
+
+def generate_function_from_ir(node, out, context):
+    context.session.begin_function(node.name)
+    context.session.statistics['functions'] += 1
+    function = yield lower_function(node, context)
+    if context.session.options['optimize'] >= 1:
+        context.session.statistics['stores_removed'] += eliminate_dead_code(function)
+    if context.session.options['dump_ir']:
+        out.emit_text(''.join(f"# {line}\n" for line in dump_ir(function).splitlines()))
+    function_start = len(out.entries)
+    generate_ir_function(function, out, context)
+    if context.session.options['optimize'] >= 1:
+        out.entries[function_start:] = optimize_peephole(out.entries[function_start:],
+                                                         context.session.statistics['peephole_removed'])
+
+
+def assembly_file_name_for(file_name):
+    return f'{os.path.splitext(file_name)[0]}.asm'
+
+
+def compile_file(file_name, options, cache_directory=None, cache_max_bytes=0):
+    cache = None
+    if cache_directory is not None:
+        cache = CompileCache(cache_directory, cache_max_bytes)
+    session = CompilerSession(cache, **options)
+    assembly_file_name = assembly_file_name_for(file_name)
     try:
-        file_name = argv[1]
-    except:
-        file_name = input('Enter the file name you want to compile : ').strip()
-    with open(file_name, 'r') as source_script:
-        script = source_script.read()
-        tokens = create_tokens(script)
-        tokens_iterator = peekable(tokens)
-        tree = parse_tokens(tokens_iterator)
-        compiled = generate(tree)
-        with open(f'{file_name.split(".")[0]}.asm', 'a') as assembled_file:
-            assembled_file.write(compiled)
-
-    print('Assembly Completed')
+        with open(file_name, 'rb') as source_file, map_source(source_file) as script:
+            with open(assembly_file_name, 'w') as assembled_file:
+                session.compile(script, assembled_file)
+    except BaseException:
+        # do not leave a truncated .asm behind
+        if os.path.exists(assembly_file_name):
+            os.remove(assembly_file_name)
+        raise
+    return session.statistics
+
+
+def collect_source_files(paths):
+    # directories are searched recursively for .c files, patterns are globbed
+    file_names = []
+    for path in paths:
+        if os.path.isdir(path):
+            file_names += sorted(glob.glob(os.path.join(path, '**', '*.c'), recursive=True))
+        elif glob.has_magic(path):
+            file_names += sorted(glob.glob(path, recursive=True))
+        else:
+            file_names.append(path)
+    return file_names
+
 
+def print_statistics(statistics):
+    for name, value in statistics.items():
+        if isinstance(value, dict):
+            for key, count in sorted(value.items()):
+                print(f"{name}.{key}: {count}")
+        elif isinstance(value, float):
+            print(f"{name}: {value:.3f}")
+        else:
+            print(f"{name}: {value}")
+
+
+def compile_batch(file_names, jobs, options, cache_directory=None, cache_max_bytes=0, show_statistics=False):
+    # fans the files out over worker processes, a failing file is reported in
+    # the summary and does not stop the rest of the batch
+    start = time.perf_counter()
+    failures = 0
+    totals = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(compile_file, file_name, options, cache_directory, cache_max_bytes)
+                   for file_name in file_names]
+        for file_name, future in zip(file_names, futures):
+            try:
+                statistics = future.result()
+            except Exception as error:
+                failures += 1
+                print(f"{file_name}: FAILED {type(error).__name__}: {error}")
+            else:
+                add_statistics(totals, statistics)
+                cached = ' (cached)' if statistics['cache_hits'] else ''
+                print(f"{file_name}: {statistics['seconds']:.3f}s{cached}")
+
+    elapsed = time.perf_counter() - start
+    print(f"compiled {len(file_names) - failures} of {len(file_names)} files with {jobs} jobs in {elapsed:.3f}s, "
+          f"{failures} failed")
+    if cache_directory is not None and totals:
+        print(f"cache: {totals['cache_hits']} hits, {totals['cache_misses']} misses")
+    if show_statistics and totals:
+        print_statistics(totals)
+    return failures
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description='Compile C code into assembly')
+    parser.add_argument('paths', nargs='*', help='C files, directories or glob patterns to compile')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='compile the files in a batch over this many worker processes')
+    parser.add_argument('-O', dest='optimize', type=int, choices=(0, 1), default=1,
+                        help='optimization level, 0 generates the program as written on a stack machine (default 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='generate and write each function as soon as it is parsed')
+    parser.add_argument('--codegen-jobs', type=int, default=1,
+                        help='parse and generate the functions of a file over this many worker processes')
+    parser.add_argument('--backend', choices=('ast', 'ir'), default='ast',
+                        help='generate the assembly straight from the syntax tree or through the '
+                             'three address ir (default ast)')
+    parser.add_argument('--dump-ir', action='store_true',
+                        help='use the ir backend and write the ir of every function as comments ahead of its assembly')
+    parser.add_argument('--whole-program', action='store_true',
+                        help='the file is the whole program, leave out the global variables no function uses')
+    parser.add_argument('--omit-frame-pointer', action='store_true',
+                        help='leave out the %%rbp frame of functions that call nothing and keep nothing on the stack')
+    parser.add_argument('--cache-dir',
+                        help='reuse the assembly of unchanged files from this cache directory')
+    parser.add_argument('--cache-size', type=int, default=512,
+                        help='evict least recently used cache entries beyond this many megabytes')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the compile statistics, including what each peephole rule removed')
+    args = parser.parse_args()
+    options = dict(optimize=args.optimize, stream=args.stream, codegen_jobs=args.codegen_jobs,
+                   backend='ir' if args.dump_ir else args.backend, dump_ir=args.dump_ir,
+                   whole_program=args.whole_program, omit_frame_pointer=args.omit_frame_pointer)
+    cache_max_bytes = args.cache_size * 1024 * 1024
+
+    paths = args.paths
+    if not paths:
+        paths = [input('Enter the file name you want to compile : ').strip()]
+    file_names = collect_source_files(paths)
+
+    if len(file_names) == 1 and args.jobs is None:
+        statistics = compile_file(file_names[0], options, args.cache_dir, cache_max_bytes)
+        print('Assembly Completed')
+        if args.cache_dir is not None:
+            print(f"cache: {statistics['cache_hits']} hits, {statistics['cache_misses']} misses")
+        if args.stats:
+            print_statistics(statistics)
+    else:
+        failed = compile_batch(file_names, args.jobs or os.cpu_count(), options, args.cache_dir, cache_max_bytes,
+                               args.stats)
+        if failed:
+            sys.exit(1)